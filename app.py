@@ -1,6 +1,29 @@
+import contextlib
+
 from shiny import App
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Mount, Route
 
 from ui import ui_main
-from server import server
+from server import is_ready, server, start_warm_up
+
+
+def ready(request):
+    # 503 tant que les données ne sont pas chargées, pour ne pas recevoir de
+    # trafic pendant le démarrage du worker
+    if is_ready():
+        return PlainTextResponse("ready")
+    return PlainTextResponse("warming up", status_code=503)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    start_warm_up()
+    yield
+
 
-app = App(ui_main, server)
+app = Starlette(
+    routes=[Route("/ready", ready), Mount("/", app=App(ui_main, server))],
+    lifespan=lifespan,
+)
@@ -0,0 +1,158 @@
+"""
+Time the slope and cross-section hot paths on synthetic data and write the
+results as JSON, to compare them between commits:
+
+    python -m benchmarks.run_benchmarks --output bench.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy
+
+from benchmarks.synthetic_data import (
+    generate_elevation_profile,
+    generate_transect_chain,
+)
+from src.cross_section.create_cross_section_points import create_cross_section_points
+from src.rdp_significance import get_rdp_significance
+from src.slope_calculation import (
+    baseline_slope_calculation,
+    get_interpolated_rdp_slope,
+    get_rdp_points,
+)
+
+PROFILE_SIZE_LIST = [1000, 10000]
+TRANSECT_SIZE_LIST = [100, 1000]
+RDP_EPSILON = 0.1
+DISTANCE = 1
+REPEAT = 3
+
+
+def time_function(function, repeat, *args, **kwargs):
+    duration_list = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        duration_list.append(time.perf_counter() - start)
+    return duration_list
+
+
+def get_result(name, size, duration_list):
+    return {
+        "name": name,
+        "size": size,
+        "repeat": len(duration_list),
+        "min_s": min(duration_list),
+        "median_s": statistics.median(duration_list),
+    }
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_slope_benchmarks(profile_size_list, repeat):
+    result_list = []
+    for size in profile_size_list:
+        pk_array, elevation_array = generate_elevation_profile(size)
+        result_list.append(
+            get_result(
+                "baseline_slope_calculation",
+                size,
+                time_function(
+                    baseline_slope_calculation, repeat, pk_array, elevation_array
+                ),
+            )
+        )
+        result_list.append(
+            get_result(
+                "get_rdp_points",
+                size,
+                time_function(
+                    get_rdp_points, repeat, pk_array, elevation_array, RDP_EPSILON
+                ),
+            )
+        )
+        result_list.append(
+            get_result(
+                "get_rdp_significance",
+                size,
+                time_function(get_rdp_significance, repeat, pk_array, elevation_array),
+            )
+        )
+        rdp_points_kept = get_rdp_points(pk_array, elevation_array, RDP_EPSILON)
+        result_list.append(
+            get_result(
+                "get_interpolated_rdp_slope",
+                size,
+                time_function(
+                    get_interpolated_rdp_slope, repeat, pk_array, rdp_points_kept
+                ),
+            )
+        )
+    return result_list
+
+
+def run_cross_section_benchmarks(transect_size_list, repeat):
+    result_list = []
+    for size in transect_size_list:
+        data = generate_transect_chain(size)
+        with tempfile.TemporaryDirectory() as folder_save_path:
+            duration_list = time_function(
+                create_cross_section_points,
+                repeat,
+                data,
+                DISTANCE,
+                folder_save_path,
+                True,
+            )
+        result_list.append(
+            get_result("create_cross_section_points", size, duration_list)
+        )
+    return result_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="JSON file, printed when not given")
+    parser.add_argument(
+        "--profile-sizes", type=int, nargs="+", default=PROFILE_SIZE_LIST
+    )
+    parser.add_argument(
+        "--transect-sizes", type=int, nargs="+", default=TRANSECT_SIZE_LIST
+    )
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    args = parser.parse_args()
+
+    benchmark_dict = {
+        "metadata": {
+            "date": datetime.now(timezone.utc).isoformat(),
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "platform": platform.platform(),
+        },
+        "results": run_slope_benchmarks(args.profile_sizes, args.repeat)
+        + run_cross_section_benchmarks(args.transect_sizes, args.repeat),
+    }
+    benchmark_json = json.dumps(benchmark_dict, indent=4)
+    if args.output is None:
+        print(benchmark_json)
+    else:
+        with open(args.output, "w") as f:
+            f.write(benchmark_json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import geopandas
+import numpy
+from shapely.geometry import Polygon
+
+
+def generate_elevation_profile(nb_points, pk_spacing=5, noise=0.05, seed=0):
+    """
+    Elevation profile of a river going down 1 m per km with riffles, plus a
+    gaussian noise of standard deviation noise (m).
+    """
+    rng = numpy.random.default_rng(seed)
+    pk_array = numpy.arange(nb_points) * float(pk_spacing)
+    riffle_array = numpy.cumsum(rng.exponential(0.02, nb_points))
+    elevation_array = (
+        100
+        - pk_array / 1000
+        - riffle_array
+        + 0.5 * numpy.sin(pk_array / 500)
+        + rng.normal(0, noise, nb_points)
+    )
+    return pk_array, elevation_array
+
+
+def generate_transect_chain(
+    nb_transects, pk_spacing=5, width=20, seed=0, crs="EPSG:2949"
+):
+    """
+    Chain of adjacent transect polygons along a meandering centerline, with
+    the PK, Q_IMG_spli, Slope and LB_Q25_COR attributes of the real
+    Transects_Level_2 shapefiles. Consecutive transects share an edge.
+    """
+    rng = numpy.random.default_rng(seed)
+    s = numpy.arange(nb_transects + 1) * float(pk_spacing)
+    x = 300000 + s
+    y = 5000000 + 20 * numpy.sin(s / 50)
+    dx = numpy.gradient(x)
+    dy = numpy.gradient(y)
+    norm = numpy.hypot(dx, dy)
+    half_width = (width + rng.normal(0, 1, nb_transects + 1)) / 2
+    left_x = x - dy / norm * half_width
+    left_y = y + dx / norm * half_width
+    right_x = x + dy / norm * half_width
+    right_y = y - dx / norm * half_width
+    polygon_list = [
+        Polygon(
+            [
+                (left_x[i], left_y[i]),
+                (left_x[i + 1], left_y[i + 1]),
+                (right_x[i + 1], right_y[i + 1]),
+                (right_x[i], right_y[i]),
+            ]
+        )
+        for i in range(nb_transects)
+    ]
+    _, elevation_array = generate_elevation_profile(
+        nb_transects, pk_spacing=pk_spacing, seed=seed
+    )
+    return geopandas.GeoDataFrame(
+        {
+            "PK": s[:-1],
+            "LB_Q25_COR": elevation_array,
+            "Q_IMG_spli": rng.uniform(1, 50, nb_transects),
+            "Slope": rng.uniform(0.0001, 0.01, nb_transects),
+        },
+        geometry=polygon_list,
+        crs=crs,
+    )
@@ -1,11 +1,39 @@
-import geopandas
+import os
+from pathlib import Path
 
-from src.cross_section.create_cross_section_points import create_cross_section_points
+from src.cross_section.create_cross_section_points import (
+    create_cross_section_points_from_file,
+)
+from src.cross_section.instrumentation import PipelineInstrumentation
 
 TRANSECT_DATA_PATH = "../data/cross_section/Transects_Level_2_ESC.shp"
 SAVING_FOLDER_PATH = "../data/cross_section/points/"
 DISTANCE = 1
+N_JOBS = os.cpu_count()
+OUTPUT_FORMAT = "gpkg"
+CACHE_PATH = "../data/cross_section/points/cross_section_cache.sqlite"
+# Temps par étape et statut de chaque transect, écrit dans trace.csv
+IS_INSTRUMENTED = False
+# Le fichier est lu par morceaux de READ_CHUNK_SIZE PK, dans n'importe quel ordre
+READ_CHUNK_SIZE = 20000
 
 if __name__ == "__main__":
-    data = geopandas.read_file(TRANSECT_DATA_PATH)
-    create_cross_section_points(data, DISTANCE, SAVING_FOLDER_PATH, True)
+    instrumentation = PipelineInstrumentation() if IS_INSTRUMENTED else None
+    cache_count_dict = create_cross_section_points_from_file(
+        TRANSECT_DATA_PATH,
+        DISTANCE,
+        SAVING_FOLDER_PATH,
+        True,
+        n_jobs=N_JOBS,
+        output_format=OUTPUT_FORMAT,
+        cache_path=CACHE_PATH,
+        instrumentation=instrumentation,
+        read_chunk_size=READ_CHUNK_SIZE,
+    )
+    print(
+        f"Cache: {cache_count_dict['nb_cache_hit']} hits, "
+        f"{cache_count_dict['nb_cache_miss']} misses"
+    )
+    if IS_INSTRUMENTED:
+        print(instrumentation.get_summary())
+        instrumentation.write_trace(Path(SAVING_FOLDER_PATH, "trace.csv"))
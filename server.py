@@ -1,32 +1,155 @@
-import pickle
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
 import numpy
-import geopandas
 import plotly.graph_objects as go
-from shiny import render, reactive, Session, ui
+from shiny import render, reactive, req, Session, ui
 from shinywidgets import render_widget
 
+from src.downsampling import get_lod_index_list, get_lod_xy
+from src.epsilon_selection import compute_epsilon_metrics, select_epsilon_by_reach
+from src.export import get_slope_column_by_pk, load_transect_attributes
+from src.export_job import ExportCancelled, ExportJobManager
+from src.slope_cache import get_slope_cache_store
+from src.slope_store import EPSILON_LRU_SIZE
+from ui import RDP_EPSILON_DEFAULT
+
+TRANSECT_DATA_PATH = "data/shp/Transects_Level_2_LBRUT.shp"
+ELEVATION_COLUMN = "LB_Q25_COR"
+SLOPE_CACHE_PATH = "data/slope_cache"
+EXPORT_FOLDER_PATH = "data/export"
+EXPORT_PROGRESS_INTERVAL = 0.25
+EXPORT_BLOCK_SIZE = 2**20
+# Scattergl dessine les traces avec WebGL
+USE_SCATTERGL = False
+READY_EVENT = threading.Event()
+WARM_UP_LOCK = threading.Lock()
+warm_up_thread = None
+export_job_manager = ExportJobManager(EXPORT_FOLDER_PATH)
+
+
+def load_slope_store():
+    return get_slope_cache_store(TRANSECT_DATA_PATH, ELEVATION_COLUMN, SLOPE_CACHE_PATH)
+
+
+@functools.lru_cache(maxsize=None)
+def get_store_lod_index_list(slope_store, name):
+    if name == "baseline_slope":
+        return get_lod_index_list(slope_store.baseline_slope[:, 1])
+    return get_lod_index_list(getattr(slope_store, name))
+
+
+@functools.lru_cache(maxsize=EPSILON_LRU_SIZE)
+def get_epsilon_lod_index_list(slope_store, epsilon, name):
+    # Shared by the sessions, the levels of the rdp traces are the slow part
+    # of an epsilon change on long reaches
+    return get_lod_index_list(slope_store.get_epsilon_data(epsilon)[name][:, 1])
+
+
+@functools.lru_cache(maxsize=None)
+def get_store_epsilon_metric_table(slope_store):
+    # Computed once per store on the epsilon grid of the cache, the curves
+    # are then drawn without any computation
+    return compute_epsilon_metrics(
+        numpy.array(slope_store.pk_array),
+        numpy.array(slope_store.elevation_array),
+        slope_store.epsilon_array,
+        significance_array=slope_store.rdp_significance,
+        baseline_slope_array=slope_store.baseline_slope[:, 1],
+    )
+
+
+def create_lod_trace(x_array, y_array, lod_index_list, **kwargs):
+    x, y = get_lod_xy(x_array, y_array, lod_index_list)
+    scatter = go.Scattergl if USE_SCATTERGL else go.Scatter
+    return scatter(x=x, y=y, **kwargs)
+
+
+def refine_on_zoom(fig, lod_data_list):
+    """
+    Resend the points of each trace of fig when its x range changes, at the
+    level of detail of the new range. lod_data_list holds the
+    (x_array, y_array, lod_index_list) of each trace.
+    """
+
+    def refine(layout, x_range):
+        with fig.batch_update():
+            for trace, lod_data in zip(fig.data, lod_data_list):
+                trace.x, trace.y = get_lod_xy(*lod_data, x_range)
+
+    fig.layout.on_change(refine, "xaxis.range")
+
+
+def update_lod_trace(fig, trace_index, lod_data, **kwargs):
+    # Only the data of this trace is sent to the browser
+    with fig.batch_update():
+        trace = fig.data[trace_index]
+        trace.x, trace.y = get_lod_xy(*lod_data, fig.layout.xaxis.range)
+        trace.update(**kwargs)
+
+
+def warm_up():
+    """
+    Load and check the slope store and compute what every new session
+    needs, so the first session of a worker is as fast as the next ones.
+    """
+    slope_store = load_slope_store()
+    get_store_lod_index_list(slope_store, "elevation_array")
+    get_store_lod_index_list(slope_store, "baseline_slope")
+    get_store_epsilon_metric_table(slope_store)
+    for name in ("rdp_points_kept_array", "rpd_slope_interpolation"):
+        get_epsilon_lod_index_list(slope_store, RDP_EPSILON_DEFAULT, name)
+    READY_EVENT.set()
+
+
+def start_warm_up():
+    # Un seul warm_up par worker, lancé au démarrage ou par la première session
+    global warm_up_thread
+    with WARM_UP_LOCK:
+        if warm_up_thread is None:
+            warm_up_thread = threading.Thread(target=warm_up, daemon=True)
+            warm_up_thread.start()
+
+
+def is_ready():
+    return READY_EVENT.is_set()
+
 
 def server(input, output, session: Session):
-    def load_data_dict():
-        with open("data/data_dict.pkl", "rb") as f:
-            data_dict = pickle.load(f)
-        return data_dict
+    # Le store est chargé par warm_up, la session attend READY_EVENT sans
+    # bloquer la boucle d'événements
+    is_store_ready = reactive.Value(is_ready())
+
+    @reactive.Effect
+    async def wait_for_store():
+        start_warm_up()
+        await asyncio.to_thread(READY_EVENT.wait)
+        is_store_ready.set(True)
+
+    @reactive.Calc
+    def get_slope_store():
+        req(is_store_ready())
+        return load_slope_store()
 
     def get_pk_and_elevation_array():
-        data_dict = load_data_dict()
-        elevation_array = data_dict["elevation_array"]
-        pk_array = data_dict["pk_array"]
+        slope_store = get_slope_store()
+        elevation_array = slope_store.elevation_array
+        pk_array = slope_store.pk_array
         return pk_array, elevation_array
 
     def get_baseline_slope():
-        data_dict = load_data_dict()
-        baseline_slope_array = data_dict["baseline_slope"]
+        slope_store = get_slope_store()
+        baseline_slope_array = slope_store.baseline_slope
         return baseline_slope_array
 
     @reactive.Calc
     def get_current_epsilon_data():
-        data_dict = load_data_dict()
-        epsilon_data = data_dict["rdp_epsilon"][input.rdp_epsilon()]
+        # Vide pendant la saisie, les effets attendent une valeur
+        req(input.rdp_epsilon() is not None)
+        slope_store = get_slope_store()
+        epsilon_data = slope_store.get_epsilon_data(input.rdp_epsilon())
         return epsilon_data
 
     @reactive.Calc
@@ -45,53 +168,88 @@ def server(input, output, session: Session):
     def get_string_epsion():
         return str(input.rdp_epsilon()).replace(".", "_")
 
+    # Export demandé par cette session, le job peut être partagé avec
+    # d'autres sessions
+    current_export_request = reactive.Value(None)
+
+    @reactive.Effect
+    @reactive.event(input.cancel_export)
+    def cancel_export():
+        export_request = current_export_request.get()
+        if export_request is not None and not export_request["is_cancelled"]:
+            export_request["is_cancelled"] = True
+            export_request["job"].cancel()
+
     @render.download(
-        filename=lambda: f"/Transects_Level_2_LBRUT_rdp_{get_string_epsion()}.csv"
+        filename=lambda: (
+            f"/Transects_Level_2_LBRUT_rdp_{get_string_epsion()}.{input.export_format()}"
+        )
     )
-    def download_csv_file():
-        with ui.Progress(min=0, max=2) as p:
-            p.set(1, message="Computing")
-            df = geopandas.read_file("data/shp/Transects_Level_2_LBRUT.shp")
-            rdp_points_kept_array = get_rdp_points_kept()
-            baseline_slope_array = get_baseline_slope()
-            rpd_slope_interpolation = get_interpolated_rdp_slope()
-            df["elev_rdp"] = numpy.nan
-            df["base_slope"] = numpy.nan
-            df["rdp_slope"] = numpy.nan
-            for pk, elevation in rdp_points_kept_array:
-                df.loc[df["PK"] == pk, "elev_rdp"] = elevation
-            for pk, slope in baseline_slope_array:
-                df.loc[df["PK"] == pk, "base_slope"] = slope
-            for pk, slope in rpd_slope_interpolation:
-                df.loc[df["PK"] == pk, "rdp_slope"] = slope
-            yield df.to_csv()
+    async def download_csv_file():
+        # L'export tourne dans le pool de threads, la session reste réactive
+        slope_column_by_pk = get_slope_column_by_pk(
+            get_rdp_points_kept(),
+            get_baseline_slope(),
+            get_interpolated_rdp_slope(),
+        )
+        job = export_job_manager.submit(
+            get_slope_store().folder_path.name,
+            input.rdp_epsilon(),
+            input.export_format(),
+            lambda: load_transect_attributes(TRANSECT_DATA_PATH),
+            slope_column_by_pk,
+        )
+        export_request = {"job": job, "is_cancelled": False}
+        current_export_request.set(export_request)
+        with ui.Progress(min=0, max=1) as p:
+            while not job.future.done() and not export_request["is_cancelled"]:
+                p.set(job.progress, message=job.message)
+                await asyncio.sleep(EXPORT_PROGRESS_INTERVAL)
+            try:
+                if export_request["is_cancelled"]:
+                    raise ExportCancelled(job.path)
+                path = job.future.result()
+            except (ExportCancelled, concurrent.futures.CancelledError):
+                ui.notification_show("Export annulé", type="warning")
+                return
             p.set(1, message="File downloaded")
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(EXPORT_BLOCK_SIZE), b""):
+                yield block
+
+    # Les figures sont créées une fois par session, seule la trace rdp est
+    # mise à jour quand epsilon change
+    subset_rdp_points_lod_data_list = []
+    slope_lod_data_list = []
 
     @render_widget
     def generate_subset_rdp_points_plot():
         pk_array, elevation_array = get_pk_and_elevation_array()
-        rdp_points_kept_array = get_rdp_points_kept()
-        rdp_points_kept_array = get_rdp_points_kept()
         nb_points_original = len(pk_array)
-        nb_points_kept = rdp_points_kept_array.shape[0]
-        fig = go.Figure()
+        subset_rdp_points_lod_data_list[:] = [
+            (
+                pk_array,
+                elevation_array,
+                get_store_lod_index_list(get_slope_store(), "elevation_array"),
+            ),
+            (pk_array[:0], elevation_array[:0], []),
+        ]
+        fig = go.FigureWidget()
         fig.add_trace(
-            go.Scatter(
-                x=pk_array,
-                y=elevation_array,
+            create_lod_trace(
+                *subset_rdp_points_lod_data_list[0],
                 mode="lines+markers",
                 name=f"Profil d'élévation original n={nb_points_original}",
             )
         )
         fig.update_traces(marker=dict(size=4))
         fig.add_trace(
-            go.Scatter(
-                x=rdp_points_kept_array[:, 0],
-                y=rdp_points_kept_array[:, 1],
+            create_lod_trace(
+                *subset_rdp_points_lod_data_list[1],
                 mode="lines+markers",
-                name=f"Profil d'élévation rdp n={nb_points_kept}",
             )
         )
+        refine_on_zoom(fig, subset_rdp_points_lod_data_list)
         fig.update_layout(
             yaxis=dict(title="Élévation (m)"),
             xaxis=dict(title="Point Kilométrique (m)"),
@@ -100,6 +258,25 @@ def server(input, output, session: Session):
         )
         return fig
 
+    @reactive.Effect
+    def update_subset_rdp_points_plot():
+        fig = generate_subset_rdp_points_plot.widget
+        rdp_points_kept_array = get_rdp_points_kept()
+        nb_points_kept = rdp_points_kept_array.shape[0]
+        subset_rdp_points_lod_data_list[1] = (
+            rdp_points_kept_array[:, 0],
+            rdp_points_kept_array[:, 1],
+            get_epsilon_lod_index_list(
+                get_slope_store(), input.rdp_epsilon(), "rdp_points_kept_array"
+            ),
+        )
+        update_lod_trace(
+            fig,
+            1,
+            subset_rdp_points_lod_data_list[1],
+            name=f"Profil d'élévation rdp n={nb_points_kept}",
+        )
+
     @reactive.Calc
     def get_max_y_slope():
         return input.max_y_slope()
@@ -122,25 +299,31 @@ def server(input, output, session: Session):
         # plt.tight_layout()
         # return fig
         baseline_slope_array = get_baseline_slope()
-        rpd_slope_interpolation = get_interpolated_rdp_slope()
-        fig = go.Figure()
+        slope_lod_data_list[:] = [
+            (
+                baseline_slope_array[:, 0],
+                baseline_slope_array[:, 1],
+                get_store_lod_index_list(get_slope_store(), "baseline_slope"),
+            ),
+            (baseline_slope_array[:0, 0], baseline_slope_array[:0, 1], []),
+        ]
+        fig = go.FigureWidget()
         fig.add_trace(
-            go.Scatter(
-                x=baseline_slope_array[:, 0],
-                y=baseline_slope_array[:, 1],
+            create_lod_trace(
+                *slope_lod_data_list[0],
                 mode="lines+markers",
                 name="Pente de référence",
             )
         )
         fig.update_traces(marker=dict(size=4))
         fig.add_trace(
-            go.Scatter(
-                x=rpd_slope_interpolation[:, 0],
-                y=rpd_slope_interpolation[:, 1],
+            create_lod_trace(
+                *slope_lod_data_list[1],
                 mode="lines+markers",
                 name="Pente rdp",
             )
         )
+        refine_on_zoom(fig, slope_lod_data_list)
         fig.update_layout(
             yaxis=dict(title="Élévation (m)"),
             xaxis=dict(title="Point Kilométrique (m)"),
@@ -148,3 +331,77 @@ def server(input, output, session: Session):
             height=600,
         )
         return fig
+
+    @reactive.Effect
+    def update_slope_plot():
+        fig = generate_slope_plot.widget
+        rpd_slope_interpolation = get_interpolated_rdp_slope()
+        slope_lod_data_list[1] = (
+            rpd_slope_interpolation[:, 0],
+            rpd_slope_interpolation[:, 1],
+            get_epsilon_lod_index_list(
+                get_slope_store(), input.rdp_epsilon(), "rpd_slope_interpolation"
+            ),
+        )
+        update_lod_trace(fig, 1, slope_lod_data_list[1])
+
+    @render_widget
+    def generate_epsilon_metric_plot():
+        metric_table = get_store_epsilon_metric_table(get_slope_store())
+        fig = go.FigureWidget()
+        for name, column, yaxis in (
+            ("RMSE de l'élévation (m)", "elevation_rmse", "y"),
+            ("RMSE de la pente", "slope_rmse", "y2"),
+            ("Compression", "compression_ratio", "y3"),
+        ):
+            fig.add_trace(
+                go.Scatter(
+                    x=metric_table["epsilon"],
+                    y=metric_table[column],
+                    mode="lines",
+                    name=name,
+                    yaxis=yaxis,
+                )
+            )
+        fig.add_vline(x=RDP_EPSILON_DEFAULT, line_dash="dash")
+        fig.update_layout(
+            xaxis=dict(title="Epsilon", domain=[0, 0.85]),
+            yaxis=dict(title="RMSE de l'élévation (m)"),
+            yaxis2=dict(title="RMSE de la pente", overlaying="y", side="right"),
+            yaxis3=dict(
+                title="Compression",
+                overlaying="y",
+                side="right",
+                anchor="free",
+                position=0.95,
+                type="log",
+            ),
+            title="Erreur selon epsilon",
+            height=600,
+        )
+        return fig
+
+    @reactive.Effect
+    def update_epsilon_metric_plot():
+        fig = generate_epsilon_metric_plot.widget
+        epsilon = input.rdp_epsilon()
+        req(epsilon is not None)
+        with fig.batch_update():
+            fig.layout.shapes[0].x0 = epsilon
+            fig.layout.shapes[0].x1 = epsilon
+
+    @reactive.Effect
+    @reactive.event(input.select_epsilon)
+    def select_epsilon():
+        req(input.epsilon_target() is not None)
+        selection = select_epsilon_by_reach(
+            get_store_epsilon_metric_table(get_slope_store()),
+            input.epsilon_criterion(),
+            input.epsilon_target(),
+        ).iloc[0]
+        ui.update_numeric("rdp_epsilon", value=float(selection["epsilon"]))
+        if not selection["is_target_met"]:
+            ui.notification_show(
+                "Aucun epsilon n'atteint la cible, le plus proche est choisi",
+                type="warning",
+            )
@@ -0,0 +1,73 @@
+import hashlib
+import pickle
+import sqlite3
+
+import numpy
+import shapely
+
+# À incrémenter quand le contenu des fragments change
+CROSS_SECTION_CACHE_VERSION = 2
+
+
+def get_transect_hash(
+    transect_polygon, polygon_before, polygon_after, qi, si, manning, distance
+):
+    """
+    Hash of everything the cross sections of a transect depend on: its
+    geometry, the geometries of its neighbours and its parameters.
+    """
+    transect_hash = hashlib.sha256(str(CROSS_SECTION_CACHE_VERSION).encode())
+    for geometry in (transect_polygon, polygon_before, polygon_after):
+        transect_hash.update(shapely.to_wkb(geometry))
+    transect_hash.update(
+        numpy.array([qi, si, manning, distance], dtype=float).tobytes()
+    )
+    return transect_hash.hexdigest()
+
+
+class CrossSectionCache:
+    """
+    Persistent cache of the fragment of result computed for each transect,
+    stored in a SQLite file keyed by PK and transect hash. A transect whose
+    geometry, neighbours or parameters changed gets a new hash and is
+    recomputed, the others are read back from the cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS transect_fragment "
+            "(pk REAL, transect_hash TEXT, fragment BLOB, "
+            "PRIMARY KEY (pk, transect_hash))"
+        )
+        self.nb_hit = 0
+        self.nb_miss = 0
+
+    def get(self, pk, transect_hash):
+        row = self.connection.execute(
+            "SELECT fragment FROM transect_fragment WHERE pk = ? AND transect_hash = ?",
+            (float(pk), transect_hash),
+        ).fetchone()
+        if row is None:
+            self.nb_miss += 1
+            return None
+        self.nb_hit += 1
+        return pickle.loads(row[0])
+
+    def set(self, pk, transect_hash, fragment):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO transect_fragment VALUES (?, ?, ?)",
+            (float(pk), transect_hash, pickle.dumps(fragment)),
+        )
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
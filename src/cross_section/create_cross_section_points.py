@@ -1,53 +1,87 @@
 import geopandas
-import pandas
+import numpy
+import time
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from shapely.geometry import LineString, Point
+import shapely
 from tqdm import tqdm
 
 from src.cross_section.utils import (
-    retrieve_polygon_for_pk,
-    get_points_of_contact_between_two_polygon,
+    build_pk_index,
+    build_spatial_index,
+    retrieve_neighbour_polygon,
+    get_points_of_contact_between_polygon_arrays,
     farthest_points_from_list_of_points,
-    get_boundaries_points_list,
-    adjust_point_to_be_on_polygon_edge,
-    get_extremities_points_from_points_before_and_after,
-    create_all_points_from_shore_points_list,
+    get_boundaries_points_array,
+    adjust_points_array_to_be_on_polygon_edge,
+    get_extremities_points_array_from_points_before_and_after,
+    create_all_points_from_shore_points_array,
+    get_segment_length,
 )
+from src.cross_section.cache import CrossSectionCache, get_transect_hash
+from src.cross_section.instrumentation import (
+    NULL_INSTRUMENTATION,
+    PipelineInstrumentation,
+)
+from src.cross_section.points import CrossSectionPoints
+from src.cross_section.writer import GeoDataFrameWriter
+from src.transect_loader import READ_CHUNK_SIZE, get_pk_chunk_list, read_transects
 
 MANNING = 0.037
+PK_SPACING = 5
+CHUNK_SIZE = 500
+TRANSECT_COLUMN_LIST = ["PK", "Q_IMG_spli", "Slope"]
 
 
-def create_cross_section_points(
-    data, distance, folder_save_path, save_boudaries_points_and_line=False
-):
-    pk_list = []
-    error_list = []
-    z_list = []
-    points_list = []
-    boundary_list = []
-    line_list = []
-    epsg = data.crs.to_epsg()
-    for i in tqdm(range(1, len(data) - 1)):
-        pk = data.loc[i]["PK"]
-        transect_polygon = data.loc[i].geometry
-        qi = data.loc[i]["Q_IMG_spli"]
-        si = data.loc[i]["Slope"]
-        if si == 0:
-            continue
+def create_empty_result_dict():
+    # The points are built in batch from the shore points of each cross section
+    return {
+        "pk_list": [],
+        "qi_list": [],
+        "si_list": [],
+        "shore_points_list": [],
+        "error_list": [],
+        "boundary_list": [],
+        "line_list": [],
+        "nb_cache_hit": 0,
+        "nb_cache_miss": 0,
+    }
 
-        polygon_before = retrieve_polygon_for_pk(data, pk - 5)
-        polygon_after = retrieve_polygon_for_pk(data, pk + 5)
 
-        intersect_points_before = get_points_of_contact_between_two_polygon(
-            transect_polygon, polygon_before
-        )
-        intersect_points_after = get_points_of_contact_between_two_polygon(
-            transect_polygon, polygon_after
-        )
+def add_cross_section_shore_points(result_dict, shore_points, pk, qi, si):
+    result_dict["shore_points_list"].append(shore_points)
+    result_dict["pk_list"].append(pk)
+    result_dict["qi_list"].append(qi)
+    result_dict["si_list"].append(si)
 
-        if len(intersect_points_before) == 0 or len(intersect_points_after) == 0:
-            continue
 
+def create_transect_fragment(
+    intersect_points_before,
+    intersect_points_after,
+    instrumentation=NULL_INSTRUMENTATION,
+):
+    """
+    What one transect adds to the result dict, from its points of contact
+    with the transects before and after: the shore points of its cross
+    sections, the (4, 2) coordinates of its boundary points and (2, 2, 2) of
+    its lines, and whether its adjusted points collapsed (reported in
+    error_list). The two middle points are returned aside, they are snapped
+    on the edge of the transect in batch and added with
+    add_shore_points_on_edge.
+    """
+    fragment = {
+        "shore_points_list": [],
+        "boundary_list": [],
+        "line_list": [],
+        "is_error": False,
+    }
+    if len(intersect_points_before) == 0 or len(intersect_points_after) == 0:
+        return fragment, None
+
+    with instrumentation.stage("farthest_points"):
         intersect_points_before = farthest_points_from_list_of_points(
             intersect_points_before
         )
@@ -55,52 +89,479 @@ def create_cross_section_points(
             intersect_points_after
         )
 
-        # Ajouter les points qui sont sur la frontière en amont
-        intersect_points_after_point_class = [
-            Point(point[0], point[1]) for point in intersect_points_after
-        ]
-        uptstream_middle_points_list = create_all_points_from_shore_points_list(
-            intersect_points_after_point_class, qi, MANNING, si, distance
-        )
-        points_list.extend(uptstream_middle_points_list)
-        pk_list.extend([pk] * len(uptstream_middle_points_list))
-        z_list.extend([point.coords[0][2] for point in uptstream_middle_points_list])
-        ###
+    # Ajouter les points qui sont sur la frontière en amont
+    fragment["shore_points_list"].append(intersect_points_after)
+    ###
 
-        boundary_list.extend(
-            get_boundaries_points_list(intersect_points_before, intersect_points_after)
-        )
+    fragment["boundary_list"].append(
+        get_boundaries_points_array(intersect_points_before, intersect_points_after)
+    )
 
+    with instrumentation.stage("extremities_points"):
         (
-            int_point_list,
-            int_line_list,
-        ) = get_extremities_points_from_points_before_and_after(
+            middle_points,
+            line_coords,
+        ) = get_extremities_points_array_from_points_before_and_after(
             intersect_points_before, intersect_points_after
         )
-        line_list.extend(int_line_list)
+    fragment["line_list"].append(line_coords)
 
-        adjusted_point_list = adjust_point_to_be_on_polygon_edge(
-            int_point_list, transect_polygon
-        )
+    return fragment, middle_points
+
+
+def add_shore_points_on_edge(fragment, adjusted_points):
+    if get_segment_length(adjusted_points[:1], adjusted_points[1:])[0] == 0:
+        fragment["is_error"] = True
+    else:
+        fragment["shore_points_list"].append(adjusted_points)
 
-        if LineString(adjusted_point_list).length == 0:
-            error_list.append(i)
+
+def add_transect_fragment(result_dict, fragment, pk, qi, si, original_i):
+    for shore_points in fragment["shore_points_list"]:
+        add_cross_section_shore_points(result_dict, shore_points, pk, qi, si)
+    result_dict["boundary_list"].extend(fragment["boundary_list"])
+    result_dict["line_list"].extend(fragment["line_list"])
+    if fragment["is_error"]:
+        result_dict["error_list"].append(original_i)
+
+
+def create_cross_section_points_for_positions(
+    data,
+    position_list,
+    distance,
+    result_dict,
+    original_position_list=None,
+    cache=None,
+    instrumentation=NULL_INSTRUMENTATION,
+):
+    """
+    Add to result_dict the cross-section points of the transects at
+    position_list in data. original_position_list is what is reported in
+    error_list when data is a subset of the full transect table. With a
+    CrossSectionCache, only the transects missing from it are computed. The
+    points of contact between the transects to compute and their neighbours
+    are found in one batch.
+    """
+    if original_position_list is None:
+        original_position_list = position_list
+    pk_index = build_pk_index(data)
+    spatial_index = build_spatial_index(data)
+    pk_array = data["PK"].values
+    geometry_array = data.geometry.values
+    qi_array = data["Q_IMG_spli"].values
+    si_array = data["Slope"].values
+    transect_list = []
+    for i, original_i in zip(position_list, original_position_list):
+        start = time.perf_counter()
+        pk = pk_array[i]
+        qi = qi_array[i]
+        si = si_array[i]
+        if si == 0:
+            instrumentation.record_transect(
+                pk, original_i, "slope_zero", time.perf_counter() - start
+            )
             continue
 
-        all_middle_points_list = create_all_points_from_shore_points_list(
-            adjusted_point_list, qi, MANNING, si, distance
+        transect = {
+            "pk": pk,
+            "qi": qi,
+            "si": si,
+            "original_i": original_i,
+            "polygon": geometry_array[i],
+            "fragment": None,
+        }
+        with instrumentation.stage("polygon_lookup"):
+            transect["polygon_before"] = retrieve_neighbour_polygon(
+                data, i, -PK_SPACING, pk_index, spatial_index
+            )
+            transect["polygon_after"] = retrieve_neighbour_polygon(
+                data, i, PK_SPACING, pk_index, spatial_index
+            )
+
+        if cache is not None:
+            with instrumentation.stage("cache_lookup"):
+                transect["transect_hash"] = get_transect_hash(
+                    transect["polygon"],
+                    transect["polygon_before"],
+                    transect["polygon_after"],
+                    qi,
+                    si,
+                    MANNING,
+                    distance,
+                )
+                transect["fragment"] = cache.get(pk, transect["transect_hash"])
+        transect["is_cached"] = transect["fragment"] is not None
+        transect["duration"] = time.perf_counter() - start
+        transect_list.append(transect)
+
+    computed_transect_list = [
+        transect for transect in transect_list if not transect["is_cached"]
+    ]
+    geometry_array_dict = {
+        key: numpy.array(
+            [transect[key] for transect in computed_transect_list], dtype=object
         )
-        points_list.extend(all_middle_points_list)
-        pk_list.extend([pk] * len(all_middle_points_list))
-        z_list.extend([point.coords[0][2] for point in all_middle_points_list])
+        for key in ("polygon", "polygon_before", "polygon_after")
+    }
+    with instrumentation.stage("contact_points"):
+        intersect_points_before_list = get_points_of_contact_between_polygon_arrays(
+            geometry_array_dict["polygon"], geometry_array_dict["polygon_before"]
+        )
+        intersect_points_after_list = get_points_of_contact_between_polygon_arrays(
+            geometry_array_dict["polygon"], geometry_array_dict["polygon_after"]
+        )
+    edge_transect_list = []
+    middle_points_list = []
+    for transect, intersect_points_before, intersect_points_after in zip(
+        computed_transect_list,
+        intersect_points_before_list,
+        intersect_points_after_list,
+    ):
+        start = time.perf_counter()
+        transect["fragment"], middle_points = create_transect_fragment(
+            intersect_points_before,
+            intersect_points_after,
+            instrumentation,
+        )
+        if middle_points is not None:
+            edge_transect_list.append(transect)
+            middle_points_list.append(middle_points)
+        transect["duration"] += time.perf_counter() - start
 
-    if save_boudaries_points_and_line:
-        geo_df_int = geopandas.GeoDataFrame(geometry=boundary_list, crs=f"EPSG:{epsg}")
-        geo_df_int.to_file(Path(folder_save_path, f"boundary_points_{distance}m.shp"))
+    with instrumentation.stage("adjust_points_on_edge"):
+        adjusted_points_array = adjust_points_array_to_be_on_polygon_edge(
+            numpy.array(middle_points_list).reshape(-1, 2, 2),
+            numpy.array(
+                [transect["polygon"] for transect in edge_transect_list], dtype=object
+            ),
+        )
+    for transect, adjusted_points in zip(edge_transect_list, adjusted_points_array):
+        add_shore_points_on_edge(transect["fragment"], adjusted_points)
+    if cache is not None:
+        for transect in computed_transect_list:
+            cache.set(transect["pk"], transect["transect_hash"], transect["fragment"])
+
+    for transect in transect_list:
+        fragment = transect["fragment"]
+        add_transect_fragment(
+            result_dict,
+            fragment,
+            transect["pk"],
+            transect["qi"],
+            transect["si"],
+            transect["original_i"],
+        )
+        if fragment["is_error"]:
+            status = "error"
+        elif len(fragment["shore_points_list"]) == 0:
+            status = "no_contact"
+        elif transect["is_cached"]:
+            status = "cached"
+        else:
+            status = "ok"
+        instrumentation.record_transect(
+            transect["pk"], transect["original_i"], status, transect["duration"]
+        )
+
+    if cache is not None:
+        result_dict["nb_cache_hit"] += cache.nb_hit
+        result_dict["nb_cache_miss"] += cache.nb_miss
+    return result_dict
+
+
+def create_cross_section_points_array(result_dict, distance):
+    all_points_array, cross_section_index = create_all_points_from_shore_points_array(
+        numpy.array(result_dict["shore_points_list"], dtype=float).reshape(-1, 2, 2),
+        numpy.array(result_dict["qi_list"], dtype=float),
+        MANNING,
+        numpy.array(result_dict["si_list"], dtype=float),
+        distance,
+    )
+    return CrossSectionPoints.from_points_array(
+        all_points_array,
+        cross_section_index,
+        numpy.array(result_dict["pk_list"], dtype=float),
+    )
+
+
+def create_boundary_geodataframes(result_dict, crs):
+    # Les géométries sont créées une seule fois, pour tout le chunk
+    return (
+        geopandas.GeoDataFrame(
+            geometry=shapely.points(
+                numpy.array(result_dict["boundary_list"], dtype=float).reshape(-1, 2)
+            ),
+            crs=crs,
+        ),
+        geopandas.GeoDataFrame(
+            geometry=shapely.linestrings(
+                numpy.array(result_dict["line_list"], dtype=float).reshape(-1, 2, 2)
+            ),
+            crs=crs,
+        ),
+    )
+
+
+def get_neighbourhood_positions(data, position_array, pk_index, spatial_index):
+    """
+    Positions of the transects needed to process the transects at
+    position_array: themselves, the transects at PK +/- PK_SPACING and the
+    transects touching them (used when the PK spacing is broken).
+    """
+    pk_array = data["PK"].values
+    neighbourhood_position_list = [
+        position_array,
+        spatial_index.query(data.geometry.values[position_array])[1],
+    ]
+    for pk in pk_array[position_array]:
+        for neighbour_pk in (pk - PK_SPACING, pk + PK_SPACING):
+            if neighbour_pk in pk_index:
+                neighbourhood_position_list.append(pk_index[neighbour_pk])
+    return numpy.unique(numpy.concatenate(neighbourhood_position_list))
+
+
+def create_cross_section_points_for_chunk(
+    work_unit, distance, cache_path=None, is_instrumented=False
+):
+    """
+    Run in a worker process, the chunk data only holds the needed transects.
+    The points of the chunk are returned in the result dict as a
+    CrossSectionPoints. When is_instrumented, the PipelineInstrumentation of
+    the chunk is returned in the result dict.
+    """
+    chunk_data, position_array, original_array = work_unit
+    result_dict = create_empty_result_dict()
+    instrumentation = NULL_INSTRUMENTATION
+    if is_instrumented:
+        instrumentation = PipelineInstrumentation()
+        result_dict["instrumentation"] = instrumentation
+    with ExitStack() as stack:
+        cache = None
+        if cache_path is not None:
+            cache = stack.enter_context(CrossSectionCache(cache_path))
+        create_cross_section_points_for_positions(
+            chunk_data,
+            position_array,
+            distance,
+            result_dict,
+            original_array,
+            cache,
+            instrumentation,
+        )
+    with instrumentation.stage("points_interpolation"):
+        result_dict["points"] = create_cross_section_points_array(result_dict, distance)
+    return result_dict
+
+
+def iter_chunk_work_units(data, chunk_size, position_array=None):
+    # Par défaut, toutes les lignes sauf la première et la dernière
+    if position_array is None:
+        position_array = numpy.arange(1, len(data) - 1)
+    pk_index = build_pk_index(data)
+    spatial_index = build_spatial_index(data)
+    for start in range(0, len(position_array), chunk_size):
+        original_array = position_array[start : start + chunk_size]
+        neighbourhood_array = get_neighbourhood_positions(
+            data, original_array, pk_index, spatial_index
+        )
+        chunk_data = data.iloc[neighbourhood_array].reset_index(drop=True)
+        chunk_position_array = numpy.searchsorted(neighbourhood_array, original_array)
+        yield chunk_data, chunk_position_array, original_array
+
+
+def iter_chunk_results(
+    data,
+    distance,
+    chunk_size,
+    n_jobs,
+    cache_path=None,
+    is_instrumented=False,
+    position_array=None,
+):
+    """
+    Yield the result dict of each chunk of the transects at position_array
+    (every row but the first and the last if None), in row order. With
+    n_jobs > 1 the chunks are processed by a pool of n_jobs processes, with at
+    most 2 * n_jobs chunks in flight so the results do not pile up in memory.
+    """
+    create_chunk = partial(
+        create_cross_section_points_for_chunk,
+        distance=distance,
+        cache_path=cache_path,
+        is_instrumented=is_instrumented,
+    )
+    work_unit_iterator = iter_chunk_work_units(data, chunk_size, position_array)
+    if n_jobs == 1:
+        yield from map(create_chunk, work_unit_iterator)
+        return
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        future_queue = deque()
+        for work_unit in work_unit_iterator:
+            future_queue.append(executor.submit(create_chunk, work_unit))
+            if len(future_queue) >= 2 * n_jobs:
+                yield future_queue.popleft().result()
+        while future_queue:
+            yield future_queue.popleft().result()
+
+
+def write_cross_section_results(
+    result_iterator,
+    crs,
+    distance,
+    folder_save_path,
+    save_boudaries_points_and_line=False,
+    output_format="shp",
+    instrumentation=None,
+    nb_chunk=None,
+):
+    """
+    Write the result dict of each chunk yielded by result_iterator as soon as
+    it arrives, see create_cross_section_points. Return the number of cache
+    hits and misses.
+    """
+    is_instrumented = instrumentation is not None
+    if instrumentation is None:
+        instrumentation = NULL_INSTRUMENTATION
+    points_writer = GeoDataFrameWriter(
+        Path(folder_save_path, f"cross_section_points_{distance}m"), output_format
+    )
+    boundary_points_writer = GeoDataFrameWriter(
+        Path(folder_save_path, f"boundary_points_{distance}m"), output_format
+    )
+    boundary_lines_writer = GeoDataFrameWriter(
+        Path(folder_save_path, f"boundary_lines_{distance}m"), output_format
+    )
+    nb_cache_hit = 0
+    nb_cache_miss = 0
+    for result_dict in tqdm(result_iterator, total=nb_chunk):
+        nb_cache_hit += result_dict["nb_cache_hit"]
+        nb_cache_miss += result_dict["nb_cache_miss"]
+        instrumentation.count("cache_hit", result_dict["nb_cache_hit"])
+        instrumentation.count("cache_miss", result_dict["nb_cache_miss"])
+        if is_instrumented:
+            instrumentation.merge(result_dict["instrumentation"])
+        if save_boudaries_points_and_line:
+            with instrumentation.stage("writing"):
+                (
+                    boundary_points_geo_df,
+                    boundary_lines_geo_df,
+                ) = create_boundary_geodataframes(result_dict, crs)
+                boundary_points_writer.write(boundary_points_geo_df)
+                boundary_lines_writer.write(boundary_lines_geo_df)
+            instrumentation.count("boundary_points", len(boundary_points_geo_df))
+            instrumentation.count("boundary_lines", len(boundary_lines_geo_df))
+        points = result_dict["points"]
+        with instrumentation.stage("writing"):
+            points_writer.write(points.to_geodataframe(crs))
+        instrumentation.count("cross_sections", points.nb_cross_section)
+        instrumentation.count("points", len(points))
+
+    with instrumentation.stage("writing"):
+        if save_boudaries_points_and_line:
+            boundary_points_writer.close()
+            boundary_lines_writer.close()
+        points_writer.close()
+    return {"nb_cache_hit": nb_cache_hit, "nb_cache_miss": nb_cache_miss}
+
+
+def create_cross_section_points(
+    data,
+    distance,
+    folder_save_path,
+    save_boudaries_points_and_line=False,
+    n_jobs=1,
+    chunk_size=CHUNK_SIZE,
+    output_format="shp",
+    cache_path=None,
+    instrumentation=None,
+):
+    """
+    The transects are processed in chunks of chunk_size transects and the
+    points of each chunk are written as soon as it is done, so the memory
+    used does not grow with the length of the reach. output_format is one of
+    OUTPUT_FORMAT_LIST. With n_jobs > 1, the chunks are processed by a pool
+    of n_jobs processes and the files are the same as with n_jobs=1.
+    With cache_path, the result of each transect is kept in a CrossSectionCache
+    at this path and a rerun only recomputes the transects that changed.
+    Pass a PipelineInstrumentation to record the time spent in each stage and
+    the status of each transect. Return the number of cache hits and misses.
+    """
+    return write_cross_section_results(
+        iter_chunk_results(
+            data, distance, chunk_size, n_jobs, cache_path, instrumentation is not None
+        ),
+        f"EPSG:{data.crs.to_epsg()}",
+        distance,
+        folder_save_path,
+        save_boudaries_points_and_line,
+        output_format,
+        instrumentation,
+        nb_chunk=len(range(1, len(data) - 1, chunk_size)),
+    )
+
+
+def create_cross_section_points_from_file(
+    path,
+    distance,
+    folder_save_path,
+    save_boudaries_points_and_line=False,
+    n_jobs=1,
+    chunk_size=CHUNK_SIZE,
+    output_format="shp",
+    cache_path=None,
+    instrumentation=None,
+    read_chunk_size=READ_CHUNK_SIZE,
+    bbox=None,
+):
+    """
+    create_cross_section_points on the transects of the file at path (only
+    those intersecting bbox if given), read by ranges of read_chunk_size
+    distinct PK with only the columns of TRANSECT_COLUMN_LIST. Each range
+    is read with the transects around it, up to PK_SPACING and the next
+    PK on each side, so the rows of the file can be in any order. The
+    transects with the lowest and highest PK have a missing neighbour and
+    are left out, like the first and last rows of the table with
+    create_cross_section_points. The points are written by PK range, in
+    file order within a range. Return the number of cache hits and misses.
+    """
+    pk_array = read_transects(path, ["PK"], bbox=bbox, ignore_geometry=True)[
+        "PK"
+    ].to_numpy(dtype=float)
+    if len(pk_array) == 0:
+        return {"nb_cache_hit": 0, "nb_cache_miss": 0}
+    pk_min, pk_max = pk_array.min(), pk_array.max()
 
-        geo_df_int_ls = geopandas.GeoDataFrame(geometry=line_list, crs=f"EPSG:{epsg}")
-        geo_df_int_ls.to_file(Path(folder_save_path, f"boundary_lines_{distance}m.shp"))
+    def iter_pk_chunk_results():
+        for (chunk_pk_min, chunk_pk_max), read_pk_range in get_pk_chunk_list(
+            pk_array, read_chunk_size, PK_SPACING
+        ):
+            data = read_transects(
+                path, TRANSECT_COLUMN_LIST, bbox=bbox, pk_range=read_pk_range
+            )
+            data_pk_array = data["PK"].to_numpy(dtype=float)
+            position_array = numpy.flatnonzero(
+                (data_pk_array >= chunk_pk_min)
+                & (data_pk_array < chunk_pk_max)
+                & (data_pk_array != pk_min)
+                & (data_pk_array != pk_max)
+            )
+            yield from iter_chunk_results(
+                data,
+                distance,
+                chunk_size,
+                n_jobs,
+                cache_path,
+                instrumentation is not None,
+                position_array,
+            )
 
-    df = pandas.DataFrame({"PK": pk_list, "z": z_list})
-    geo_df = geopandas.GeoDataFrame(df, geometry=points_list, crs=f"EPSG:{epsg}")
-    geo_df.to_file(Path(folder_save_path, f"cross_section_points_{distance}m.shp"))
+    crs = read_transects(path, ["PK"], rows=slice(0, 1)).crs
+    return write_cross_section_results(
+        iter_pk_chunk_results(),
+        f"EPSG:{crs.to_epsg()}",
+        distance,
+        folder_save_path,
+        save_boudaries_points_and_line,
+        output_format,
+        instrumentation,
+    )
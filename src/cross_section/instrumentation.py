@@ -0,0 +1,90 @@
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+import pandas
+
+
+class PipelineInstrumentation:
+    """
+    Opt-in recorder of what create_cross_section_points spends its time on:
+    wall time and number of calls of each stage, number of objects created,
+    and the status of every transect ("ok", "cached", "slope_zero",
+    "no_contact" or "error"). It can be pickled, so each worker process fills
+    its own and the results are merged back with merge.
+    """
+
+    def __init__(self):
+        self.stage_time_dict = Counter()
+        self.stage_call_dict = Counter()
+        self.object_count_dict = Counter()
+        self.transect_record_list = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_time_dict[name] += time.perf_counter() - start
+            self.stage_call_dict[name] += 1
+
+    def count(self, name, nb=1):
+        self.object_count_dict[name] += nb
+
+    def record_transect(self, pk, position, status, duration):
+        self.transect_record_list.append(
+            {"PK": pk, "position": position, "status": status, "duration_s": duration}
+        )
+
+    def merge(self, other):
+        self.stage_time_dict.update(other.stage_time_dict)
+        self.stage_call_dict.update(other.stage_call_dict)
+        self.object_count_dict.update(other.object_count_dict)
+        self.transect_record_list.extend(other.transect_record_list)
+
+    def get_status_count(self):
+        return Counter(record["status"] for record in self.transect_record_list)
+
+    def get_summary(self):
+        line_list = [f"{'stage':<28}{'calls':>10}{'total (s)':>12}{'mean (ms)':>12}"]
+        for name, total in sorted(
+            self.stage_time_dict.items(), key=lambda item: -item[1]
+        ):
+            nb_call = self.stage_call_dict[name]
+            line_list.append(
+                f"{name:<28}{nb_call:>10}{total:>12.3f}{1000 * total / nb_call:>12.3f}"
+            )
+        line_list.append("")
+        for name, nb in sorted(self.object_count_dict.items()):
+            line_list.append(f"{name:<28}{nb:>10}")
+        line_list.append("")
+        for status, nb in sorted(self.get_status_count().items()):
+            line_list.append(f"transects {status:<18}{nb:>10}")
+        return "\n".join(line_list)
+
+    def write_trace(self, path):
+        # One row per transect: PK, position in the data, status and duration
+        pandas.DataFrame(
+            self.transect_record_list,
+            columns=["PK", "position", "status", "duration_s"],
+        ).sort_values("position", kind="stable").to_csv(path, index=False)
+
+
+class NullInstrumentation:
+    # Same interface as PipelineInstrumentation, records nothing
+
+    def stage(self, name):
+        return nullcontext()
+
+    def count(self, name, nb=1):
+        pass
+
+    def record_transect(self, pk, position, status, duration):
+        pass
+
+    def merge(self, other):
+        pass
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
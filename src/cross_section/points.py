@@ -0,0 +1,114 @@
+import json
+
+import numpy
+import shapely
+
+
+class CrossSectionPoints:
+    """
+    Points of many cross sections stored in contiguous float64 x, y and z
+    arrays instead of one shapely Point per point. The points of the cross
+    section i are those from offset_array[i] to offset_array[i + 1], and its
+    PK is pk_array[i].
+    """
+
+    __slots__ = ("coords", "pk_array", "offset_array")
+
+    def __init__(self, coords, pk_array, offset_array):
+        # (3, n): x, y et z sont chacun contigus en mémoire
+        self.coords = numpy.ascontiguousarray(coords, dtype=numpy.float64)
+        self.pk_array = numpy.asarray(pk_array)
+        self.offset_array = numpy.asarray(offset_array, dtype=numpy.int64)
+        if self.coords.ndim != 2 or self.coords.shape[0] != 3:
+            raise ValueError(f"coords must have shape (3, n), got {self.coords.shape}")
+        if len(self.offset_array) != len(self.pk_array) + 1:
+            raise ValueError("offset_array must hold one offset more than pk_array")
+        if self.offset_array[0] != 0 or self.offset_array[-1] != self.coords.shape[1]:
+            raise ValueError("offset_array must go from 0 to the number of points")
+
+    @classmethod
+    def from_points_array(cls, points_array, cross_section_index, pk_array):
+        """
+        From the (n, 3) coordinates of the points, grouped by cross section,
+        and the cross section of each point.
+        """
+        nb_points_array = numpy.bincount(cross_section_index, minlength=len(pk_array))
+        offset_array = numpy.concatenate([[0], numpy.cumsum(nb_points_array)])
+        return cls(numpy.asarray(points_array).T, pk_array, offset_array)
+
+    @property
+    def x(self):
+        return self.coords[0]
+
+    @property
+    def y(self):
+        return self.coords[1]
+
+    @property
+    def z(self):
+        return self.coords[2]
+
+    @property
+    def nb_cross_section(self):
+        return len(self.pk_array)
+
+    @property
+    def point_pk_array(self):
+        # PK of each point
+        return numpy.repeat(self.pk_array, numpy.diff(self.offset_array))
+
+    def __len__(self):
+        return self.coords.shape[1]
+
+    def get_cross_section(self, i):
+        """(k, 3) view on the points of the cross section i."""
+        return self.coords[:, self.offset_array[i] : self.offset_array[i + 1]].T
+
+    def to_geodataframe(self, crs=None):
+        """
+        GeoDataFrame with the PK, z and geometry of each point. The x, y, z
+        arrays are read in place, the Point geometries are created in one
+        vectorized call.
+        """
+        import geopandas
+        import pandas
+
+        df = pandas.DataFrame({"PK": self.point_pk_array, "z": self.z})
+        return geopandas.GeoDataFrame(
+            df, geometry=shapely.points(self.coords.T), crs=crs
+        )
+
+    def to_geoarrow(self, crs=None):
+        """
+        pyarrow Table with the PK, z and a geoarrow.point geometry column in
+        the separated (struct of x, y, z) encoding. The coordinate columns
+        are buffers of the x, y, z arrays, nothing is copied.
+        """
+        import pyarrow
+
+        geometry_array = pyarrow.StructArray.from_arrays(
+            [pyarrow.array(self.x), pyarrow.array(self.y), pyarrow.array(self.z)],
+            fields=[
+                pyarrow.field(name, pyarrow.float64(), nullable=False)
+                for name in ("x", "y", "z")
+            ],
+        )
+        extension_metadata = {} if crs is None else {"crs": str(crs)}
+        geometry_field = pyarrow.field(
+            "geometry",
+            geometry_array.type,
+            metadata={
+                "ARROW:extension:name": "geoarrow.point",
+                "ARROW:extension:metadata": json.dumps(extension_metadata),
+            },
+        )
+        return pyarrow.Table.from_arrays(
+            [pyarrow.array(self.point_pk_array), pyarrow.array(self.z), geometry_array],
+            schema=pyarrow.schema(
+                [
+                    pyarrow.field("PK", pyarrow.from_numpy_dtype(self.pk_array.dtype)),
+                    pyarrow.field("z", pyarrow.float64()),
+                    geometry_field,
+                ]
+            ),
+        )
@@ -1,14 +1,58 @@
+import functools
 import geopandas
+import shapely
 from shapely.geometry import LineString, Point, MultiPolygon
 import numpy
-import itertools
 
 
 POSSIBLE_COMBINAISONS = [[[0, 0], [1, 1]], [[0, 1], [1, 0]]]
+FARTHEST_POINTS_BRUTE_FORCE_SIZE = 32
 
 
-def retrieve_polygon_for_pk(data, pk):
-    polygon_list = data[data["PK"] == pk].geometry.values
+def build_pk_index(data):
+    # Positions of the rows of every PK, in row order
+    return data.groupby("PK", sort=False).indices
+
+
+def build_spatial_index(data):
+    return shapely.STRtree(data.geometry.values)
+
+
+def retrieve_polygon_for_pk(data, pk, pk_index=None):
+    if pk_index is None:
+        polygon_list = data[data["PK"] == pk].geometry.values
+    else:
+        polygon_list = data.geometry.values[pk_index.get(pk, [])]
+    if len(polygon_list) == 1:
+        return polygon_list[0]
+    else:
+        return MultiPolygon(polygon_list)
+
+
+def retrieve_neighbour_polygon(data, position, pk_offset, pk_index, spatial_index):
+    """
+    Polygon of the transect at PK + pk_offset from the transect at position.
+    When no transect has this PK, fall back on the transects touching it on
+    the same side (upstream or downstream) whose PK is the closest to it.
+    """
+    pk_array = data["PK"].values
+    pk = pk_array[position]
+    if pk + pk_offset in pk_index:
+        return retrieve_polygon_for_pk(data, pk + pk_offset, pk_index)
+    geometry_array = data.geometry.values
+    candidate_array = spatial_index.query(
+        geometry_array[position], predicate="intersects"
+    )
+    candidate_pk_array = pk_array[candidate_array]
+    same_side_mask = numpy.sign(candidate_pk_array - pk) == numpy.sign(pk_offset)
+    candidate_array = candidate_array[same_side_mask]
+    if len(candidate_array) == 0:
+        return MultiPolygon()
+    pk_distance_array = numpy.abs(candidate_pk_array[same_side_mask] - pk - pk_offset)
+    candidate_array = numpy.sort(
+        candidate_array[pk_distance_array == pk_distance_array.min()]
+    )
+    polygon_list = geometry_array[candidate_array]
     if len(polygon_list) == 1:
         return polygon_list[0]
     else:
@@ -47,6 +91,62 @@ def adjust_point_to_be_on_polygon_edge(point_list, polygon):
     return adjusted_point_list
 
 
+def adjust_points_array_to_be_on_polygon_edge(
+    points_array, polygon_array, extend_factor=1
+):
+    """
+    Batch version of adjust_point_to_be_on_polygon_edge for n transects.
+    points_array is (n, k, 2), the k points of each transect. The extended
+    line of each transect is intersected once with the boundary of its
+    polygon and each point is moved to the nearest part of the intersection.
+    Return a (n, k, 2) array.
+    """
+    nb_transect, nb_points = points_array.shape[:2]
+    if nb_transect == 0:
+        return points_array.copy()
+    # Même prolongement que extend_line
+    direction_array = points_array[:, 1] - points_array[:, 0]
+    extended_coords_array = numpy.concatenate(
+        [
+            points_array,
+            (points_array[:, 1] + direction_array * extend_factor)[:, None],
+            (points_array[:, 0] - direction_array * extend_factor)[:, None],
+        ],
+        axis=1,
+    )
+    intersection_array = shapely.intersection(
+        shapely.linestrings(extended_coords_array), shapely.boundary(polygon_array)
+    )
+    part_array, part_index_array = shapely.get_parts(
+        intersection_array, return_index=True
+    )
+    is_not_empty_array = ~shapely.is_empty(part_array)
+    part_array = part_array[is_not_empty_array]
+    part_index_array = part_index_array[is_not_empty_array]
+    if len(numpy.unique(part_index_array)) != nb_transect:
+        raise ValueError("An extended line does not intersect its polygon boundary")
+    distance_array = shapely.distance(
+        shapely.points(points_array)[part_index_array], part_array[:, None]
+    )
+    # The parts are grouped by transect, the stable sort keeps the first of
+    # the nearest parts like numpy.argmin
+    first_part_array = numpy.searchsorted(part_index_array, numpy.arange(nb_transect))
+    coords_array, coords_index_array = shapely.get_coordinates(
+        part_array, return_index=True
+    )
+    first_coords_array = numpy.searchsorted(
+        coords_index_array, numpy.arange(len(part_array))
+    )
+    adjusted_points_array = numpy.empty((nb_transect, nb_points, 2))
+    for j in range(nb_points):
+        order_array = numpy.lexsort((distance_array[:, j], part_index_array))
+        nearest_part_array = order_array[first_part_array]
+        adjusted_points_array[:, j] = coords_array[
+            first_coords_array[nearest_part_array]
+        ]
+    return adjusted_points_array
+
+
 def get_boundaries_points_list(intersect_points_before, intersect_points_after):
     boundaries_points_list = []
     boundaries_points_list.append(
@@ -72,6 +172,16 @@ def get_boundaries_points_list(intersect_points_before, intersect_points_after):
     return boundaries_points_list
 
 
+def get_boundaries_points_array(intersect_points_before, intersect_points_after):
+    # (4, 2) coordinates of the points of get_boundaries_points_list
+    return numpy.concatenate(
+        [
+            numpy.asarray(intersect_points_before, dtype=float)[:2, :2],
+            numpy.asarray(intersect_points_after, dtype=float)[:2, :2],
+        ]
+    )
+
+
 def get_points_of_contact_between_two_polygon(polygon1, polygon2):
     # Find common boundary
     common_boundary = polygon1.intersection(polygon2)
@@ -88,23 +198,133 @@ def get_points_of_contact_between_two_polygon(polygon1, polygon2):
     return numpy.array(points_of_contact)
 
 
-def farthest_points_from_list_of_points(list_of_points):
-    list_of_points = geopandas.points_from_xy(
-        list_of_points[:, 0], list_of_points[:, 1]
+def get_points_of_contact_between_polygon_arrays(polygon1_array, polygon2_array):
+    """
+    get_points_of_contact_between_two_polygon for many pairs of polygons: one
+    vectorized intersection for all the pairs, then the end points of every
+    line of the common boundaries. Return one (k, 2) array per pair, empty
+    when the common boundary is not a LineString or a MultiLineString.
+    """
+    common_boundary_array = shapely.intersection(polygon1_array, polygon2_array)
+    type_id_array = shapely.get_type_id(common_boundary_array)
+    # 1: LineString, 5: MultiLineString
+    line_pair_index = numpy.flatnonzero((type_id_array == 1) | (type_id_array == 5))
+    line_array, line_index = shapely.get_parts(
+        common_boundary_array[line_pair_index], return_index=True
+    )
+    points_of_contact_array = numpy.stack(
+        [
+            shapely.get_coordinates(shapely.get_point(line_array, 0)),
+            shapely.get_coordinates(shapely.get_point(line_array, -1)),
+        ],
+        axis=1,
+    ).reshape(-1, 2)
+    nb_points_array = 2 * numpy.bincount(
+        line_pair_index[line_index], minlength=len(common_boundary_array)
     )
-    max_distance = 0
-    farthest_pair = None
+    return numpy.split(points_of_contact_array, numpy.cumsum(nb_points_array)[:-1])
+
+
+def get_convex_hull_index(points_array):
+    # Andrew's monotone chain on points sorted by x then y, counterclockwise
+    # and without collinear points
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    hull_index_list = []
+    for index_order in (range(len(points_array)), reversed(range(len(points_array)))):
+        half_hull_index_list = []
+        for i in index_order:
+            while (
+                len(half_hull_index_list) >= 2
+                and cross(
+                    points_array[half_hull_index_list[-2]],
+                    points_array[half_hull_index_list[-1]],
+                    points_array[i],
+                )
+                <= 0
+            ):
+                half_hull_index_list.pop()
+            half_hull_index_list.append(i)
+        hull_index_list.extend(half_hull_index_list[:-1])
+    return numpy.array(hull_index_list)
+
 
-    # Iterate over all pairs of points and calculate distance
-    for pair in itertools.combinations(list_of_points, 2):
-        dist = pair[0].distance(pair[1])
-        if dist > max_distance:
-            max_distance = dist
-            farthest_pair = pair
-    points_array = numpy.array(
-        [[point.xy[0][0], point.xy[1][0]] for point in farthest_pair]
+def get_antipodal_pair_index(hull_points_array):
+    """
+    Pairs of vertices of a convex hull (counterclockwise) found by rotating
+    calipers, the farthest pair of points is one of them.
+    """
+    nb_hull_points = len(hull_points_array)
+    if nb_hull_points <= 2:
+        return numpy.array([[0, nb_hull_points - 1]])
+
+    def area(i, j, k):
+        a, b, c = hull_points_array[i], hull_points_array[j], hull_points_array[k]
+        return abs((b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0]))
+
+    pair_index_list = []
+    j = 1
+    for i in range(nb_hull_points):
+        i_next = (i + 1) % nb_hull_points
+        while area(i, i_next, (j + 1) % nb_hull_points) > area(i, i_next, j):
+            j = (j + 1) % nb_hull_points
+        pair_index_list.extend([[i, j], [i_next, j]])
+        j_next = (j + 1) % nb_hull_points
+        if area(i, i_next, j_next) == area(i, i_next, j):
+            # Edge parallel to the caliper, both of its ends are antipodal
+            pair_index_list.extend([[i, j_next], [i_next, j_next]])
+    return numpy.array(pair_index_list)
+
+
+@functools.lru_cache(maxsize=None)
+def get_pair_index(nb_points):
+    # Every pair (i, j), i < j, in itertools.combinations order
+    return numpy.array(numpy.triu_indices(nb_points, k=1)).T
+
+
+def get_pair_distance(points_array, pair_index_array):
+    # Same arithmetic as shapely's distance
+    dx = (
+        points_array[pair_index_array[:, 1], 0]
+        - points_array[pair_index_array[:, 0], 0]
+    )
+    dy = (
+        points_array[pair_index_array[:, 1], 1]
+        - points_array[pair_index_array[:, 0], 1]
     )
-    return points_array
+    return numpy.sqrt(dx * dx + dy * dy)
+
+
+def farthest_points_from_list_of_points(list_of_points):
+    """
+    The two points of list_of_points the farthest apart, in their order in
+    the list. Ties are broken as when comparing every pair in
+    itertools.combinations order. Above FARTHEST_POINTS_BRUTE_FORCE_SIZE
+    points, only the antipodal vertices of the convex hull are compared
+    (rotating calipers).
+    """
+    list_of_points = numpy.asarray(list_of_points, dtype=float)[:, :2]
+    if len(list_of_points) <= FARTHEST_POINTS_BRUTE_FORCE_SIZE:
+        pair_index_array = get_pair_index(len(list_of_points))
+    else:
+        unique_points_array, first_index_array = numpy.unique(
+            list_of_points, axis=0, return_index=True
+        )
+        hull_index_array = get_convex_hull_index(unique_points_array)
+        pair_index_array = hull_index_array[
+            get_antipodal_pair_index(unique_points_array[hull_index_array])
+        ]
+        # Back to the first occurrence of each point in the list
+        pair_index_array = numpy.sort(first_index_array[pair_index_array], axis=1)
+        pair_index_array = pair_index_array[
+            numpy.lexsort((pair_index_array[:, 1], pair_index_array[:, 0]))
+        ]
+    distance_array = get_pair_distance(list_of_points, pair_index_array)
+    if len(distance_array) == 0 or distance_array.max() == 0:
+        raise ValueError
+    # argmax keeps the first of the farthest pairs
+    return list_of_points[pair_index_array[numpy.argmax(distance_array)]]
 
 
 def get_extremities_points_from_points_before_and_after(
@@ -154,12 +374,40 @@ def get_extremities_points_from_points_before_and_after(
     return points_list, line_list
 
 
+def get_extremities_points_array_from_points_before_and_after(
+    intersect_points_before, intersect_points_after
+):
+    """
+    get_extremities_points_from_points_before_and_after on coordinates:
+    return the (2, 2) middle points and the (2, 2, 2) coordinates of the two
+    lines.
+    """
+    intersect_points_before = numpy.asarray(intersect_points_before, dtype=float)
+    intersect_points_after = numpy.asarray(intersect_points_after, dtype=float)
+    for points_combinaisons_1, points_combinaisons_2 in POSSIBLE_COMBINAISONS:
+        line_coords_array = numpy.array(
+            [
+                [
+                    intersect_points_before[points_combinaisons[0]],
+                    intersect_points_after[points_combinaisons[1]],
+                ]
+                for points_combinaisons in (
+                    points_combinaisons_1,
+                    points_combinaisons_2,
+                )
+            ]
+        )
+        line_array = shapely.linestrings(line_coords_array)
+        if not shapely.intersects(line_array[0], line_array[1]):
+            # Le centroïde de shapely, pour garder les mêmes coordonnées
+            middle_points_array = shapely.get_coordinates(shapely.centroid(line_array))
+            return middle_points_array, line_coords_array
+    raise ValueError
+
+
 def add_z_to_points_list_from_z_list(points_list, z_list):
-    new_points_list = []
-    for point, z in zip(points_list, z_list):
-        x, y = point.xy
-        new_points_list.append(Point(x[0], y[0], z))
-    return new_points_list
+    coords_array = shapely.get_coordinates(numpy.array(points_list, dtype=object))
+    return list(shapely.points(coords_array[:, 0], coords_array[:, 1], z_list))
 
 
 def get_interpolated_points_from_points_list_by_a_distance(points_list, distance):
@@ -218,3 +466,121 @@ def create_all_points_from_shore_points_list(
     )
     points_list.extend(bottom_points_interpolation_list)
     return points_list
+
+
+def get_segment_length(start_array, end_array):
+    # Planar length, as shapely's length, of segments given by (n, >=2) arrays
+    dx = end_array[:, 0] - start_array[:, 0]
+    dy = end_array[:, 1] - start_array[:, 1]
+    return numpy.sqrt(dx * dx + dy * dy)
+
+
+def interpolate_on_segment(start_array, end_array, interpolation_array):
+    # Same arithmetic as shapely's line_interpolate_point(normalized=True)
+    length_array = get_segment_length(start_array, end_array)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        fraction_array = (interpolation_array * length_array) / length_array
+    fraction_array = numpy.where(length_array > 0, fraction_array, 0)
+    return start_array + fraction_array[:, None] * (end_array - start_array)
+
+
+def get_interpolated_points_from_segment_array(start_array, end_array, distance):
+    """
+    Batched get_interpolated_points_from_points_list_by_a_distance for
+    segments given by (n, 3) start and end arrays. Return the (m, 3)
+    coordinates of the interpolated points, grouped by segment, and the
+    segment of each point.
+    """
+    length_array = get_segment_length(start_array, end_array)
+    number_of_points_array = (numpy.ceil(length_array / distance) + 1).astype(int)
+    nb_interpolated_array = numpy.maximum(number_of_points_array - 2, 0)
+    segment_index = numpy.repeat(numpy.arange(len(start_array)), nb_interpolated_array)
+    segment_offset = numpy.cumsum(nb_interpolated_array) - nb_interpolated_array
+    point_rank = (
+        numpy.arange(len(segment_index))
+        - numpy.repeat(segment_offset, nb_interpolated_array)
+        + 1
+    )
+    # Same values as numpy.linspace(0, 1, number_of_points)[1:-1]
+    interpolation_array = point_rank * (
+        1.0 / (number_of_points_array[segment_index] - 1)
+    )
+    interpolated_points_array = interpolate_on_segment(
+        start_array[segment_index], end_array[segment_index], interpolation_array
+    )
+    return interpolated_points_array, segment_index
+
+
+def create_all_points_from_shore_points_array(
+    shore_points_array, qi_array, manning, si_array, distance
+):
+    """
+    Batched create_all_points_from_shore_points_list working on coordinates.
+    shore_points_array has shape (n, 2, 2): the two shore points (x, y) of n
+    cross sections. Return the (m, 3) coordinates of all their points, in the
+    same order as create_all_points_from_shore_points_list, and the cross
+    section of each point.
+    """
+    shore_points_array = numpy.asarray(shore_points_array, dtype=float)
+    nb_cross_section = len(shore_points_array)
+    first_shore_array = shore_points_array[:, 0]
+    second_shore_array = shore_points_array[:, 1]
+
+    wi = get_segment_length(first_shore_array, second_shore_array)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        di = ((qi_array * manning) / (wi * (si_array**0.5))) ** (3 / 5)
+    hi = 2 * di / 1.8
+
+    # Berges, fond puis points interpolés pour chaque section
+    fixed_points_array = numpy.zeros((nb_cross_section, 4, 3))
+    fixed_points_array[:, :2, :2] = shore_points_array
+    fixed_points_array[:, 2, :2] = interpolate_on_segment(
+        first_shore_array, second_shore_array, numpy.full(nb_cross_section, 0.1)
+    )
+    fixed_points_array[:, 3, :2] = interpolate_on_segment(
+        first_shore_array, second_shore_array, numpy.full(nb_cross_section, 0.9)
+    )
+    fixed_points_array[:, 2:, 2] = hi[:, None]
+
+    bottom_points_array = fixed_points_array[:, 2:]
+    segment_start_array = numpy.empty((nb_cross_section, 3, 3))
+    segment_end_array = numpy.empty((nb_cross_section, 3, 3))
+    for shore_rank in range(2):
+        shore_points = fixed_points_array[:, shore_rank]
+        bottom_distance_array = numpy.array(
+            [
+                get_segment_length(shore_points, bottom_points_array[:, bottom_rank])
+                for bottom_rank in range(2)
+            ]
+        )
+        closest_bottom = numpy.argmin(bottom_distance_array, axis=0)
+        segment_start_array[:, shore_rank] = shore_points
+        segment_end_array[:, shore_rank] = bottom_points_array[
+            numpy.arange(nb_cross_section), closest_bottom
+        ]
+    segment_start_array[:, 2] = bottom_points_array[:, 0]
+    segment_end_array[:, 2] = bottom_points_array[:, 1]
+
+    (
+        interpolated_points_array,
+        segment_index,
+    ) = get_interpolated_points_from_segment_array(
+        segment_start_array.reshape(-1, 3), segment_end_array.reshape(-1, 3), distance
+    )
+    interpolated_cross_section_index = segment_index // 3
+    nb_points_array = 4 + numpy.bincount(
+        interpolated_cross_section_index, minlength=nb_cross_section
+    )
+    cross_section_offset = numpy.cumsum(nb_points_array) - nb_points_array
+
+    all_points_array = numpy.empty((nb_points_array.sum(), 3))
+    fixed_points_position = (cross_section_offset[:, None] + numpy.arange(4)).ravel()
+    all_points_array[fixed_points_position] = fixed_points_array.reshape(-1, 3)
+    # The interpolated points are already grouped by cross section and segment,
+    # each one is shifted by the fixed points of its cross section and before
+    interpolated_points_position = numpy.arange(len(interpolated_points_array)) + 4 * (
+        interpolated_cross_section_index + 1
+    )
+    all_points_array[interpolated_points_position] = interpolated_points_array
+    cross_section_index = numpy.repeat(numpy.arange(nb_cross_section), nb_points_array)
+    return all_points_array, cross_section_index
@@ -0,0 +1,71 @@
+import numpy
+from pathlib import Path
+
+OUTPUT_FORMAT_LIST = ["shp", "gpkg", "parquet"]
+
+
+class GeoDataFrameWriter:
+    """
+    Write a GeoDataFrame batch after batch, so the whole result never has to
+    be held in memory.
+    - "shp": one ESRI shapefile, each batch is appended to it.
+    - "gpkg": one GeoPackage, each batch is appended to its layer.
+    - "parquet": one GeoParquet file per batch in a folder, read back as a
+      single dataset with geopandas.read_parquet(folder).
+    The extension is added to path_without_extension.
+    """
+
+    def __init__(self, path_without_extension, output_format="shp"):
+        if output_format not in OUTPUT_FORMAT_LIST:
+            raise ValueError(
+                f"output_format must be one of {OUTPUT_FORMAT_LIST}, got {output_format}"
+            )
+        self.output_format = output_format
+        self.path = Path(f"{path_without_extension}.{output_format}")
+        self.nb_batch_written = 0
+        self.nb_row_written = 0
+        self.empty_geo_df = None
+
+    def write(self, geo_df):
+        if len(geo_df) == 0:
+            # An empty batch does not give the geometry type of the layer
+            self.empty_geo_df = geo_df
+            return
+        if self.output_format == "shp" and len(geo_df.columns) == 1:
+            # The driver adds a FID field to a layer without field, but the
+            # appended batches must carry it to match the layer schema
+            geo_df = geo_df.copy()
+            geo_df.insert(
+                0,
+                "FID",
+                numpy.arange(self.nb_row_written, self.nb_row_written + len(geo_df)),
+            )
+        if self.output_format == "parquet":
+            self.path.mkdir(parents=True, exist_ok=True)
+            if self.nb_batch_written == 0:
+                # Same as overwriting the file with the other formats
+                for part_path in self.path.glob("part-*.parquet"):
+                    part_path.unlink()
+            geo_df.to_parquet(
+                Path(self.path, f"part-{self.nb_batch_written:05d}.parquet")
+            )
+        else:
+            mode = "w" if self.nb_batch_written == 0 else "a"
+            geo_df.to_file(self.path, mode=mode)
+        self.nb_batch_written += 1
+        self.nb_row_written += len(geo_df)
+
+    def close(self):
+        if self.nb_batch_written == 0 and self.empty_geo_df is not None:
+            if self.output_format == "parquet":
+                self.path.mkdir(parents=True, exist_ok=True)
+                self.empty_geo_df.to_parquet(Path(self.path, "part-00000.parquet"))
+            else:
+                self.empty_geo_df.to_file(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
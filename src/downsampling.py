@@ -0,0 +1,72 @@
+import numpy
+
+MAX_PLOT_POINTS = 4000
+FIRST_BUCKET_SIZE = 8
+
+
+def get_m4_index(y_array, bucket_size):
+    """
+    Index of the first, last, lowest and highest point of each bucket of
+    bucket_size consecutive points (M4 decimation). A line through these
+    points has the same envelope as the line through all the points.
+    NaN are never picked unless a bucket is all NaN.
+    """
+    nb_points = len(y_array)
+    nb_bucket = -(-nb_points // bucket_size)
+    padded_array = numpy.full(nb_bucket * bucket_size, numpy.nan)
+    padded_array[:nb_points] = y_array
+    bucket_array = padded_array.reshape(nb_bucket, bucket_size)
+    is_nan_array = numpy.isnan(bucket_array)
+    start_array = numpy.arange(nb_bucket) * bucket_size
+    index_array = numpy.concatenate(
+        [
+            start_array,
+            start_array + numpy.where(is_nan_array, numpy.inf, bucket_array).argmin(1),
+            start_array + numpy.where(is_nan_array, -numpy.inf, bucket_array).argmax(1),
+            start_array + bucket_size - 1,
+        ]
+    )
+    return numpy.unique(numpy.minimum(index_array, nb_points - 1))
+
+
+def get_lod_index_list(y_array, max_points=MAX_PLOT_POINTS):
+    """
+    Levels of detail of a profile: (bucket_size, index_array) with the M4
+    decimation for bucket sizes 8, 16, 32... down to the first level that
+    fits in max_points.
+    """
+    y_array = numpy.asarray(y_array, dtype=float)
+    lod_index_list = []
+    bucket_size = FIRST_BUCKET_SIZE
+    while len(y_array) > max_points:
+        index_array = get_m4_index(y_array, bucket_size)
+        lod_index_list.append((bucket_size, index_array))
+        if len(index_array) <= max_points:
+            break
+        bucket_size *= 2
+    return lod_index_list
+
+
+def get_lod_xy(
+    x_array, y_array, lod_index_list, x_range=None, max_points=MAX_PLOT_POINTS
+):
+    """
+    Points to plot for x_range (the whole profile if None), with x_array
+    sorted: all the points of the range if they fit in max_points, else
+    those of the finest level of detail that does. The point just outside
+    each side of the range is kept so the line reaches the edges.
+    """
+    start, end = 0, len(x_array)
+    if x_range is not None:
+        start, end = numpy.searchsorted(x_array, sorted(x_range))
+        start, end = max(start - 1, 0), min(end + 1, len(x_array))
+    index_array = numpy.arange(start, end)
+    for _, level_index_array in lod_index_list:
+        if len(index_array) <= max_points:
+            break
+        index_array = level_index_array[
+            numpy.searchsorted(level_index_array, start) : numpy.searchsorted(
+                level_index_array, end
+            )
+        ]
+    return x_array[index_array], y_array[index_array]
@@ -0,0 +1,274 @@
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+import pandas
+
+from src.rdp_significance import (
+    get_rdp_epsilon_breakpoints,
+    get_rdp_mask,
+    get_rdp_significance,
+)
+from src.slope_calculation import (
+    baseline_slope_calculation,
+    get_interpolated_rdp_slope_matrix,
+)
+from src.slope_table import get_sorted_reach_and_pk
+from src.transect_loader import read_transects
+
+EPSILON_METRIC_COLUMN_LIST = [
+    "epsilon",
+    "nb_points_kept",
+    "compression_ratio",
+    "elevation_rmse",
+    "slope_rmse",
+]
+SELECTION_CRITERION_LIST = ["elevation_rmse", "slope_rmse", "compression_ratio"]
+EPSILON_ARRAY = numpy.round(numpy.arange(0, 1.01, 0.01), 2)
+REACH_CHUNK_SIZE = 64
+
+
+def get_rmse(difference_matrix):
+    # RMSE of each row without its NaN (e.g. the edges of the baseline slope)
+    valid_matrix = ~numpy.isnan(difference_matrix)
+    squared_sum = numpy.where(valid_matrix, difference_matrix, 0) ** 2
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return numpy.sqrt(squared_sum.sum(axis=1) / valid_matrix.sum(axis=1))
+
+
+def compute_epsilon_metrics(
+    pk_array,
+    elevation_array,
+    epsilon_array=EPSILON_ARRAY,
+    half_window=3,
+    significance_array=None,
+    baseline_slope_array=None,
+):
+    """
+    Error of the rdp simplification of one profile for every epsilon of
+    epsilon_array: RMSE between the original elevation and the elevation
+    linearly interpolated between the kept points, RMSE between the
+    interpolated rdp slope and the baseline slope, and compression ratio
+    (number of points / number of points kept). The rdp recursion runs once
+    for all the epsilons, the significance and baseline slope are reused if
+    given, and the epsilons between the same two breakpoints of
+    get_rdp_epsilon_breakpoints share the computation of their common
+    simplification. Return a DataFrame with one row per epsilon.
+    """
+    pk_array = numpy.asarray(pk_array, dtype=float)
+    elevation_array = numpy.asarray(elevation_array, dtype=float)
+    epsilon_array = numpy.atleast_1d(numpy.asarray(epsilon_array, dtype=float))
+    if significance_array is None:
+        significance_array = get_rdp_significance(pk_array, elevation_array)
+    if baseline_slope_array is None:
+        baseline_slope_array = baseline_slope_calculation(
+            pk_array, elevation_array, half_window
+        )[:, 1]
+
+    # Même nombre de breakpoints <= epsilon, même simplification
+    simplification_array = numpy.searchsorted(
+        get_rdp_epsilon_breakpoints(significance_array), epsilon_array, side="right"
+    )
+    _, first_index_array, simplification_index_array = numpy.unique(
+        simplification_array, return_index=True, return_inverse=True
+    )
+    distinct_epsilon_array = epsilon_array[first_index_array]
+
+    nb_points_kept_array = numpy.empty(len(distinct_epsilon_array), dtype=int)
+    rdp_elevation_matrix = numpy.empty((len(distinct_epsilon_array), len(pk_array)))
+    rdp_points_kept_list = []
+    for i, epsilon in enumerate(distinct_epsilon_array):
+        mask = get_rdp_mask(significance_array, epsilon)
+        nb_points_kept_array[i] = mask.sum()
+        rdp_elevation_matrix[i] = numpy.interp(
+            pk_array, pk_array[mask], elevation_array[mask]
+        )
+        rdp_points_kept_list.append(
+            numpy.array([pk_array[mask], elevation_array[mask]]).T
+        )
+    rdp_slope_matrix = get_interpolated_rdp_slope_matrix(pk_array, rdp_points_kept_list)
+
+    return pandas.DataFrame(
+        {
+            "epsilon": epsilon_array,
+            "nb_points_kept": nb_points_kept_array[simplification_index_array],
+            "compression_ratio": (len(pk_array) / nb_points_kept_array)[
+                simplification_index_array
+            ],
+            "elevation_rmse": get_rmse(rdp_elevation_matrix - elevation_array)[
+                simplification_index_array
+            ],
+            "slope_rmse": get_rmse(rdp_slope_matrix - baseline_slope_array)[
+                simplification_index_array
+            ],
+        },
+        columns=EPSILON_METRIC_COLUMN_LIST,
+    )
+
+
+def compute_reach_chunk_epsilon_metrics(reach_chunk, epsilon_array, half_window):
+    # Run in a worker process, on the (pk_array, elevation_array) of each reach
+    return [
+        compute_epsilon_metrics(pk_array, elevation_array, epsilon_array, half_window)
+        for pk_array, elevation_array in reach_chunk
+    ]
+
+
+def compute_epsilon_metric_table(
+    df,
+    column,
+    epsilon_list=EPSILON_ARRAY,
+    reach_column=None,
+    half_window=3,
+    n_jobs=1,
+    reach_chunk_size=REACH_CHUNK_SIZE,
+):
+    """
+    compute_epsilon_metrics on the elevation column of every reach of df
+    (the values of reach_column, or the whole table if None). The reaches
+    are sent reach_chunk_size at a time to a pool of n_jobs processes when
+    n_jobs > 1. Reaches of less than two points are left out. Return a
+    DataFrame with one row per reach and epsilon.
+    """
+    epsilon_array = numpy.atleast_1d(numpy.asarray(epsilon_list, dtype=float))
+    reach_code_array, reach_label_array, order_array = get_sorted_reach_and_pk(
+        df, reach_column
+    )
+    pk_array = df["PK"].to_numpy(dtype=float)[order_array]
+    elevation_array = df[column].to_numpy(dtype=float)[order_array]
+    reach_bound_array = numpy.concatenate(
+        [[0], numpy.flatnonzero(numpy.diff(reach_code_array)) + 1, [len(pk_array)]]
+    )
+    reach_code_list = []
+    reach_list = []
+    for start, end in zip(reach_bound_array[:-1], reach_bound_array[1:]):
+        if end - start < 2:
+            continue
+        reach_code_list.append(reach_code_array[start])
+        reach_list.append((pk_array[start:end], elevation_array[start:end]))
+    reach_chunk_list = [
+        reach_list[start : start + reach_chunk_size]
+        for start in range(0, len(reach_list), reach_chunk_size)
+    ]
+
+    compute_chunk = functools.partial(
+        compute_reach_chunk_epsilon_metrics,
+        epsilon_array=epsilon_array,
+        half_window=half_window,
+    )
+    if n_jobs == 1:
+        metric_table_list_list = list(map(compute_chunk, reach_chunk_list))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            metric_table_list_list = list(executor.map(compute_chunk, reach_chunk_list))
+    metric_table_list = [
+        metric_table
+        for metric_table_list in metric_table_list_list
+        for metric_table in metric_table_list
+    ]
+    if len(metric_table_list) == 0:
+        metric_table = pandas.DataFrame(columns=EPSILON_METRIC_COLUMN_LIST)
+    else:
+        metric_table = pandas.concat(metric_table_list, ignore_index=True)
+    if reach_column is not None:
+        metric_table.insert(
+            0,
+            reach_column,
+            numpy.repeat(
+                reach_label_array[numpy.array(reach_code_list, dtype=int)],
+                len(epsilon_array),
+            ),
+        )
+    return metric_table
+
+
+def select_epsilon_by_reach(metric_table, criterion, target, reach_column=None):
+    """
+    Epsilon picked for each reach of metric_table: the largest epsilon whose
+    elevation_rmse or slope_rmse is at most target, or the smallest epsilon
+    whose compression_ratio is at least target. When no epsilon of a reach
+    meets the target, the closest one is picked (the smallest epsilon for an
+    error, the largest for the compression) and is_target_met is False.
+    Return the rows of metric_table picked, one per reach.
+    """
+    if criterion not in SELECTION_CRITERION_LIST:
+        raise ValueError(
+            f"criterion must be one of {SELECTION_CRITERION_LIST}, got {criterion}"
+        )
+    metric_array = metric_table[criterion].to_numpy(dtype=float)
+    epsilon_array = metric_table["epsilon"].to_numpy(dtype=float)
+    if criterion == "compression_ratio":
+        is_target_met_array = metric_array >= target
+        score_array = -epsilon_array
+    else:
+        is_target_met_array = metric_array <= target
+        score_array = epsilon_array
+    if reach_column is None:
+        reach_code_array = numpy.zeros(len(metric_table), dtype=int)
+    else:
+        reach_code_array = pandas.factorize(
+            metric_table[reach_column], sort=True, use_na_sentinel=False
+        )[0]
+
+    # Par bief, un epsilon qui atteint la cible passe avant les autres
+    order_array = numpy.lexsort(
+        (
+            numpy.where(is_target_met_array, score_array, -score_array),
+            is_target_met_array,
+            reach_code_array,
+        )
+    )
+    sorted_reach_code_array = reach_code_array[order_array]
+    is_last_array = numpy.ones(len(order_array), dtype=bool)
+    is_last_array[:-1] = sorted_reach_code_array[1:] != sorted_reach_code_array[:-1]
+    selected_array = order_array[is_last_array]
+    selection_table = metric_table.iloc[selected_array].reset_index(drop=True)
+    selection_table["is_target_met"] = is_target_met_array[selected_array]
+    return selection_table
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pick the rdp epsilon of every reach of a transect file"
+    )
+    parser.add_argument("path", help="transect file")
+    parser.add_argument("output_path", help="csv file of the selected epsilons")
+    parser.add_argument("--column", default="LB_Q25_COR")
+    parser.add_argument("--reach-column", default=None)
+    parser.add_argument(
+        "--criterion", choices=SELECTION_CRITERION_LIST, default="elevation_rmse"
+    )
+    parser.add_argument("--target", type=float, required=True)
+    parser.add_argument("--half-window", type=int, default=3)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument(
+        "--metric-path", default=None, help="csv file of all the metrics"
+    )
+    args = parser.parse_args()
+
+    column_list = ["PK", args.column]
+    if args.reach_column is not None:
+        column_list.append(args.reach_column)
+    df = read_transects(args.path, column_list, ignore_geometry=True)
+    metric_table = compute_epsilon_metric_table(
+        df,
+        args.column,
+        reach_column=args.reach_column,
+        half_window=args.half_window,
+        n_jobs=args.n_jobs,
+    )
+    if args.metric_path is not None:
+        metric_table.to_csv(args.metric_path, index=False)
+    selection_table = select_epsilon_by_reach(
+        metric_table, args.criterion, args.target, args.reach_column
+    )
+    selection_table.to_csv(args.output_path, index=False)
+    print(
+        f"{selection_table['is_target_met'].sum()}/{len(selection_table)} "
+        f"reaches meet the target"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import functools
+
+import numpy
+import pandas
+
+CSV_CHUNK_SIZE = 10000
+
+
+@functools.lru_cache(maxsize=None)
+def load_transect_attributes(path):
+    # Parsed once per process, callers must not modify the returned frame.
+    # geopandas is only imported when an export is requested
+    import geopandas
+
+    return geopandas.read_file(path)
+
+
+def get_value_by_pk(pk_value_array):
+    pk_value_array = numpy.asarray(pk_value_array, dtype=float).reshape(-1, 2)
+    value_by_pk = pandas.Series(pk_value_array[:, 1], index=pk_value_array[:, 0])
+    # Same as assigning the values one PK after the other: the last one wins
+    return value_by_pk[~value_by_pk.index.duplicated(keep="last")]
+
+
+def get_slope_column_by_pk(
+    rdp_points_kept_array, baseline_slope_array, rpd_slope_interpolation
+):
+    return {
+        "elev_rdp": get_value_by_pk(rdp_points_kept_array),
+        "base_slope": get_value_by_pk(baseline_slope_array),
+        "rdp_slope": get_value_by_pk(rpd_slope_interpolation),
+    }
+
+
+def add_slope_columns(df, slope_column_by_pk):
+    return df.assign(
+        **{
+            column: df["PK"].map(value_by_pk)
+            for column, value_by_pk in slope_column_by_pk.items()
+        }
+    )
+
+
+def iter_slope_csv_chunks(df, slope_column_by_pk, chunk_size=CSV_CHUNK_SIZE):
+    """
+    Yield the csv of df with the slope columns added, chunk_size rows at a
+    time. Only one chunk is joined and formatted at once, the concatenation of
+    the chunks is the same as the csv of the whole joined frame.
+    """
+    for start in range(0, max(len(df), 1), chunk_size):
+        df_chunk = add_slope_columns(
+            df.iloc[start : start + chunk_size], slope_column_by_pk
+        )
+        yield df_chunk.to_csv(header=start == 0)
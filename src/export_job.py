@@ -0,0 +1,189 @@
+import concurrent.futures
+import os
+import threading
+from pathlib import Path
+
+from src.cross_section.writer import GeoDataFrameWriter
+from src.export import CSV_CHUNK_SIZE, add_slope_columns, iter_slope_csv_chunks
+
+EXPORT_FORMAT_LIST = ["csv", "gpkg", "parquet"]
+EXPORT_MAX_WORKERS = 2
+# Taille max des exports gardés sur le disque, les plus anciens sont effacés
+EXPORT_MAX_SIZE = 2 * 2**30
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class ExportJob:
+    """
+    One export run by an ExportJobManager. progress goes from 0 to 1 with a
+    message for the user. The job is shared by every session asking for the
+    same file: each of them calls cancel at most once and the job stops
+    before its next chunk when the last of them cancels.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.progress = 0.0
+        self.message = "En attente"
+        self.cancel_event = threading.Event()
+        self.future = None
+        self.nb_requester = 1
+        self._lock = threading.Lock()
+
+    def add_requester(self):
+        # False if the job is already cancelled and can not be shared
+        with self._lock:
+            if self.cancel_event.is_set():
+                return False
+            self.nb_requester += 1
+            return True
+
+    def set_progress(self, progress, message):
+        if self.cancel_event.is_set():
+            raise ExportCancelled(self.path)
+        self.progress = progress
+        self.message = message
+
+    def cancel(self):
+        with self._lock:
+            self.nb_requester -= 1
+            if self.nb_requester > 0:
+                return
+            self.cancel_event.set()
+        self.future.cancel()
+
+
+def write_export(
+    df, slope_column_by_pk, path, export_format, job, chunk_size=CSV_CHUNK_SIZE
+):
+    """
+    Write df with the slope columns added at path, chunk_size rows at a time
+    for csv and gpkg so job reports the progress and can be cancelled between
+    two chunks. The file is written next to path and renamed at the end, so
+    path only ever holds a complete export.
+    """
+    path = Path(path)
+    temporary_path = path.with_name(
+        f"{path.stem}.tmp{threading.get_ident()}{path.suffix}"
+    )
+    nb_chunk = max(-(-len(df) // chunk_size), 1)
+    try:
+        if export_format == "csv":
+            with open(temporary_path, "w", encoding="utf-8", newline="") as f:
+                for i, csv_chunk in enumerate(
+                    iter_slope_csv_chunks(df, slope_column_by_pk, chunk_size)
+                ):
+                    job.set_progress(i / nb_chunk, f"Écriture {i}/{nb_chunk}")
+                    f.write(csv_chunk)
+        elif export_format == "gpkg":
+            writer = GeoDataFrameWriter(temporary_path.with_suffix(""), "gpkg")
+            for i, start in enumerate(range(0, max(len(df), 1), chunk_size)):
+                job.set_progress(i / nb_chunk, f"Écriture {i}/{nb_chunk}")
+                writer.write(
+                    add_slope_columns(
+                        df.iloc[start : start + chunk_size], slope_column_by_pk
+                    )
+                )
+            writer.close()
+        elif export_format == "parquet":
+            job.set_progress(0, "Écriture")
+            add_slope_columns(df, slope_column_by_pk).to_parquet(temporary_path)
+        else:
+            raise ValueError(
+                f"export_format must be one of {EXPORT_FORMAT_LIST}, got {export_format}"
+            )
+        job.set_progress(1, "Terminé")
+        os.replace(temporary_path, path)
+    finally:
+        temporary_path.unlink(missing_ok=True)
+    return path
+
+
+def run_export_job(job, load_df, slope_column_by_pk, export_format):
+    job.set_progress(0, "Lecture des transects")
+    return write_export(load_df(), slope_column_by_pk, job.path, export_format, job)
+
+
+class ExportJobManager:
+    """
+    Run the exports on a thread pool shared by every session, so the event
+    loop of a session is never blocked by an export. A finished export is
+    kept in folder_path and served again for the same dataset, epsilon and
+    format, and a running export is shared by the sessions asking for it.
+    The least recently served exports are deleted when the files of
+    folder_path take more than max_size bytes.
+    """
+
+    def __init__(
+        self,
+        folder_path,
+        max_workers=EXPORT_MAX_WORKERS,
+        max_size=EXPORT_MAX_SIZE,
+    ):
+        self.folder_path = Path(folder_path)
+        self.max_size = max_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._job_dict = {}
+        self._lock = threading.Lock()
+
+    def get_export_path(self, dataset_key, epsilon, export_format):
+        string_epsilon = str(float(epsilon)).replace(".", "_")
+        return Path(
+            self.folder_path, dataset_key, f"rdp_{string_epsilon}.{export_format}"
+        )
+
+    def submit(self, dataset_key, epsilon, export_format, load_df, slope_column_by_pk):
+        """
+        Job of the export of load_df() for this dataset, epsilon and format.
+        load_df is called in the pool.
+        """
+        path = self.get_export_path(dataset_key, epsilon, export_format)
+        with self._lock:
+            job = self._job_dict.get(path)
+            if job is not None and not job.future.done() and job.add_requester():
+                return job
+            self.evict_exports(path)
+            job = ExportJob(path)
+            if path.exists():
+                # Date de dernière utilisation pour evict_exports
+                os.utime(path)
+                job.set_progress(1, "Terminé")
+                job.future = concurrent.futures.Future()
+                job.future.set_result(path)
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                job.future = self._executor.submit(
+                    run_export_job, job, load_df, slope_column_by_pk, export_format
+                )
+            self._job_dict[path] = job
+            return job
+
+    def evict_exports(self, keep_path):
+        """
+        Delete the least recently served exports until the files of
+        folder_path take at most max_size bytes. keep_path and the exports
+        still running are kept. Called with the lock held.
+        """
+        running_path_set = {
+            path for path, job in self._job_dict.items() if not job.future.done()
+        }
+        stat_list = []
+        for path in self.folder_path.glob("*/*"):
+            if ".tmp" in path.name:
+                continue
+            try:
+                stat_list.append((path.stat().st_mtime, path.stat().st_size, path))
+            except FileNotFoundError:
+                continue
+        total_size = sum(size for _, size, _ in stat_list)
+        for _, size, path in sorted(stat_list):
+            if total_size <= self.max_size:
+                break
+            if path == keep_path or path in running_path_set:
+                continue
+            path.unlink(missing_ok=True)
+            self._job_dict.pop(path, None)
+            total_size -= size
@@ -1,7 +1,30 @@
-import geopandas
+import numpy
+import pandas
 
+from src.transect_loader import read_transects
 
-def load_data_and_drop_duplicated(path):
-    df = geopandas.read_file(path)
-    df = df.drop_duplicates(subset="PK", keep="last").reset_index(drop=True)
+
+def drop_duplicated_pk(df):
+    """
+    Same result as df.drop_duplicates(subset="PK", keep="last") with a new
+    RangeIndex. When df is sorted by PK the duplicates are next to each other
+    and are found with one comparison, and df itself is returned if it has
+    no duplicate and already has a RangeIndex.
+    """
+    if not df["PK"].is_monotonic_increasing:
+        return df.drop_duplicates(subset="PK", keep="last").reset_index(drop=True)
+    pk_array = df["PK"].to_numpy()
+    is_last_array = numpy.ones(len(pk_array), dtype=bool)
+    is_last_array[:-1] = pk_array[1:] != pk_array[:-1]
+    if is_last_array.all():
+        if df.index.equals(pandas.RangeIndex(len(df))):
+            return df
+        return df.reset_index(drop=True)
+    return df[is_last_array].reset_index(drop=True)
+
+
+def load_data_and_drop_duplicated(path, column_list=None, ignore_geometry=False):
+    # Seulement les colonnes de column_list (toutes si None)
+    df = read_transects(path, column_list, ignore_geometry=ignore_geometry)
+    df = drop_duplicated_pk(df)
     return df
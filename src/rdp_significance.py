@@ -0,0 +1,68 @@
+import numpy
+
+
+def get_perpendicular_distance(points, start_point, end_point):
+    # Same distance as rdp.pldist, for all the points at once
+    line = end_point - start_point
+    if numpy.all(line == 0):
+        return numpy.linalg.norm(points - start_point, axis=1)
+    difference = start_point - points
+    cross_product = line[0] * difference[:, 1] - line[1] * difference[:, 0]
+    return numpy.abs(cross_product) / numpy.linalg.norm(line)
+
+
+def get_rdp_significance(pk_array, elevation_array):
+    """
+    Run the Ramer-Douglas-Peucker recursion once and return, for each point,
+    the largest epsilon at which it is still kept: a point is kept by
+    rdp(epsilon) if and only if its significance is greater than epsilon.
+    The recursion is unrolled on an explicit stack so long profiles do not
+    hit the Python recursion limit.
+    """
+    rdp_starting_array = numpy.array([pk_array, elevation_array], dtype=float).T
+    nb_points = len(rdp_starting_array)
+    significance_array = numpy.zeros(nb_points)
+    if nb_points == 0:
+        return significance_array
+    significance_array[[0, -1]] = numpy.inf
+    segment_stack = [(0, nb_points - 1, numpy.inf)]
+    while segment_stack:
+        start, end, parent_significance = segment_stack.pop()
+        if end - start < 2:
+            continue
+        distance_array = get_perpendicular_distance(
+            rdp_starting_array[start + 1 : end + 1],
+            rdp_starting_array[start],
+            rdp_starting_array[end],
+        )
+        index = start + 1 + numpy.argmax(distance_array)
+        dmax = distance_array[index - start - 1]
+        if dmax <= 0:
+            continue
+        # A point can not outlive the split that created its segment
+        significance = min(dmax, parent_significance)
+        significance_array[index] = significance
+        segment_stack.append((start, index, significance))
+        segment_stack.append((index, end, significance))
+    return significance_array
+
+
+def get_rdp_mask(significance_array, epsilon):
+    return significance_array > epsilon
+
+
+def get_rdp_points_from_significance(
+    pk_array, elevation_array, significance_array, epsilon
+):
+    mask = get_rdp_mask(significance_array, epsilon)
+    rdp_points_kept = numpy.array([pk_array[mask], elevation_array[mask]]).T
+    return rdp_points_kept
+
+
+def get_rdp_epsilon_breakpoints(significance_array):
+    """
+    Epsilons at which the set of kept points changes. Every epsilon between
+    two consecutive breakpoints gives the same simplification.
+    """
+    finite_significance = significance_array[numpy.isfinite(significance_array)]
+    return numpy.unique(finite_significance[finite_significance > 0])
@@ -0,0 +1,345 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy
+
+from src.load_data import load_data_and_drop_duplicated
+from src.rdp_significance import get_rdp_points_from_significance, get_rdp_significance
+from src.slope_calculation import (
+    baseline_slope_calculation,
+    get_interpolated_rdp_slope_matrix,
+)
+from src.slope_store import SlopeStore, save_slope_store
+
+# À incrémenter quand le contenu ou le format du cache change
+SLOPE_CACHE_VERSION = 1
+SLOPE_CACHE_PATH = "data/slope_cache"
+ELEVATION_COLUMN = "LB_Q25_COR"
+HALF_WINDOW = 3
+EPSILON_ARRAY = numpy.round(numpy.arange(0, 1.01, 0.01), 2)
+HASH_BLOCK_SIZE = 2**20
+# Un seul build à la fois dans le processus, un thread qui arrive pendant un
+# build attend l'entrée au lieu d'en écrire une seconde
+SLOPE_CACHE_LOCK = threading.RLock()
+
+
+def get_file_hash(path):
+    """
+    sha256 of the file at path and of its sidecar files (same name, other
+    extension), so a shapefile changes hash when its .dbf changes.
+    """
+    path = Path(path)
+    file_hash = hashlib.sha256()
+    for file_path in sorted(path.parent.glob(f"{path.stem}.*")):
+        file_hash.update(file_path.suffix.lower().encode())
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_file_stat_list(path):
+    path = Path(path)
+    return [
+        [
+            file_path.suffix.lower(),
+            file_path.stat().st_size,
+            file_path.stat().st_mtime_ns,
+        ]
+        for file_path in sorted(path.parent.glob(f"{path.stem}.*"))
+    ]
+
+
+def get_cached_file_hash(path, cache_path=SLOPE_CACHE_PATH):
+    """
+    get_file_hash, remembered in the cache with the size and modification
+    time of the files so a warm start does not read the whole file again.
+    """
+    index_path = Path(cache_path, f"v{SLOPE_CACHE_VERSION}", "file_hash.json")
+    key = str(Path(path).resolve())
+    file_stat_list = get_file_stat_list(path)
+    file_hash_index = {}
+    if index_path.exists():
+        with open(index_path) as f:
+            file_hash_index = json.load(f)
+    if key in file_hash_index and file_hash_index[key]["stat"] == file_stat_list:
+        return file_hash_index[key]["file_hash"]
+
+    file_hash = get_file_hash(path)
+    file_hash_index[key] = {"stat": file_stat_list, "file_hash": file_hash}
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_index_path = index_path.with_name(f"{index_path.name}.tmp{os.getpid()}")
+    with open(temporary_index_path, "w") as f:
+        json.dump(file_hash_index, f, indent=2)
+    os.replace(temporary_index_path, index_path)
+    return file_hash
+
+
+def get_epsilon_list(epsilon_array):
+    return [float(epsilon) for epsilon in epsilon_array]
+
+
+def get_slope_cache_key(
+    file_hash, column, half_window=HALF_WINDOW, epsilon_array=EPSILON_ARRAY
+):
+    # Chaque grille d'epsilon a son entrée, une autre grille ne l'écrase pas
+    key = json.dumps(
+        {
+            "version": SLOPE_CACHE_VERSION,
+            "file_hash": file_hash,
+            "column": column,
+            "half_window": half_window,
+            "epsilon": get_epsilon_list(epsilon_array),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def get_slope_cache_entry_path(
+    cache_path,
+    file_hash,
+    column,
+    half_window=HALF_WINDOW,
+    epsilon_array=EPSILON_ARRAY,
+):
+    return Path(
+        cache_path,
+        f"v{SLOPE_CACHE_VERSION}",
+        get_slope_cache_key(file_hash, column, half_window, epsilon_array),
+    )
+
+
+def read_slope_cache_metadata(entry_path):
+    metadata_path = Path(entry_path, "metadata.json")
+    if not metadata_path.exists():
+        return None
+    with open(metadata_path) as f:
+        return json.load(f)
+
+
+def create_slope_data_dict(
+    pk_array, elevation_array, epsilon_array=EPSILON_ARRAY, half_window=HALF_WINDOW
+):
+    """
+    Baseline slope, rdp significance and, for each epsilon of epsilon_array,
+    the rdp points kept and the interpolated rdp slope of one profile.
+    """
+    rdp_significance = get_rdp_significance(pk_array, elevation_array)
+    rdp_points_kept_list = [
+        get_rdp_points_from_significance(
+            pk_array, elevation_array, rdp_significance, epsilon
+        )
+        for epsilon in epsilon_array
+    ]
+    rdp_slope_matrix = get_interpolated_rdp_slope_matrix(pk_array, rdp_points_kept_list)
+    data_dict = {
+        "pk_array": pk_array,
+        "elevation_array": elevation_array,
+        "baseline_slope": baseline_slope_calculation(
+            pk_array, elevation_array, half_window
+        ),
+        "rdp_significance": rdp_significance,
+        "rdp_epsilon": {},
+    }
+    for epsilon, rdp_points_kept_array, rdp_slope_array in zip(
+        epsilon_array, rdp_points_kept_list, rdp_slope_matrix
+    ):
+        data_dict["rdp_epsilon"][float(epsilon)] = {
+            "rdp_points_kept_array": rdp_points_kept_array,
+            "rpd_slope_interpolation": numpy.array([pk_array, rdp_slope_array]).T,
+        }
+    return data_dict
+
+
+def build_slope_cache_entry(
+    path,
+    column,
+    cache_path=SLOPE_CACHE_PATH,
+    epsilon_array=EPSILON_ARRAY,
+    half_window=HALF_WINDOW,
+    file_hash=None,
+    force=False,
+):
+    """
+    Compute the slope store of one column of the transects at path and save
+    it in the cache. The entry is keyed by the file, column, half_window and
+    epsilon_array, an entry already built is kept unless force is True.
+    Return the path of the entry.
+    """
+    with SLOPE_CACHE_LOCK:
+        if file_hash is None:
+            file_hash = get_file_hash(path)
+        entry_path = get_slope_cache_entry_path(
+            cache_path, file_hash, column, half_window, epsilon_array
+        )
+        epsilon_list = get_epsilon_list(epsilon_array)
+        if not force and read_slope_cache_metadata(entry_path) is not None:
+            return entry_path
+
+        df = load_data_and_drop_duplicated(path, ["PK", column], ignore_geometry=True)
+        pk_array = numpy.array(df["PK"])
+        elevation_array = numpy.array(df[column])
+        data_dict = create_slope_data_dict(
+            pk_array, elevation_array, epsilon_list, half_window
+        )
+        if entry_path.exists():
+            shutil.rmtree(entry_path)
+        save_slope_store(
+            data_dict,
+            entry_path,
+            metadata={
+                "version": SLOPE_CACHE_VERSION,
+                "path": str(path),
+                "file_hash": file_hash,
+                "column": column,
+                "half_window": half_window,
+                "epsilon": epsilon_list,
+            },
+        )
+        return entry_path
+
+
+def build_slope_cache(
+    path_list,
+    column_list,
+    cache_path=SLOPE_CACHE_PATH,
+    epsilon_array=EPSILON_ARRAY,
+    half_window=HALF_WINDOW,
+    n_jobs=1,
+    force=False,
+):
+    """
+    Build the cache entry of every (reach, column) pair, with a pool of
+    n_jobs processes when n_jobs > 1. path_list holds one transect file per
+    reach. Return the entry paths in the same order as the pairs.
+    """
+    file_hash_dict = {
+        path: get_cached_file_hash(path, cache_path) for path in path_list
+    }
+    build_entry = functools.partial(
+        build_slope_cache_entry,
+        cache_path=cache_path,
+        epsilon_array=epsilon_array,
+        half_window=half_window,
+        force=force,
+    )
+    pair_list = [(path, column) for path in path_list for column in column_list]
+    if n_jobs == 1:
+        return [
+            build_entry(path, column, file_hash=file_hash_dict[path])
+            for path, column in pair_list
+        ]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        future_list = [
+            executor.submit(build_entry, path, column, file_hash=file_hash_dict[path])
+            for path, column in pair_list
+        ]
+        return [future.result() for future in future_list]
+
+
+def find_slope_cache_entry_list(cache_path, file_hash, column, half_window=HALF_WINDOW):
+    """
+    Paths of the entries of the file, column and half_window, whatever their
+    epsilon grid, the last built first.
+    """
+    entry_path_list = []
+    for metadata_path in Path(cache_path, f"v{SLOPE_CACHE_VERSION}").glob(
+        "*/metadata.json"
+    ):
+        # Dossier d'un build en cours
+        if ".tmp" in metadata_path.parent.name:
+            continue
+        metadata = read_slope_cache_metadata(metadata_path.parent)
+        if (
+            metadata is not None
+            and metadata["file_hash"] == file_hash
+            and metadata["column"] == column
+            and metadata["half_window"] == half_window
+        ):
+            entry_path_list.append(
+                (metadata_path.stat().st_mtime_ns, metadata_path.parent)
+            )
+    return [entry_path for _, entry_path in sorted(entry_path_list, reverse=True)]
+
+
+def get_slope_cache_store(
+    path, column=ELEVATION_COLUMN, cache_path=SLOPE_CACHE_PATH, half_window=HALF_WINDOW
+):
+    """
+    Process-wide SlopeStore of one column of the transects at path: the last
+    built entry of the file, column and half_window that passes
+    SlopeStore.validate, whatever its epsilon grid. If there is none, the
+    entry is built with the default epsilon grid. The threads that ask for
+    it during the build wait for that build.
+    """
+    with SLOPE_CACHE_LOCK:
+        return _get_slope_cache_store(path, column, cache_path, half_window)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_slope_cache_store(path, column, cache_path, half_window):
+    file_hash = get_cached_file_hash(path, cache_path)
+    for entry_path in find_slope_cache_entry_list(
+        cache_path, file_hash, column, half_window
+    ):
+        try:
+            SlopeStore(entry_path).validate()
+        except ValueError:
+            continue
+        return SlopeStore(entry_path)
+    entry_path = build_slope_cache_entry(
+        path,
+        column,
+        cache_path,
+        half_window=half_window,
+        file_hash=file_hash,
+        force=True,
+    )
+    return SlopeStore(entry_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute the baseline and rdp slopes of transect files"
+    )
+    parser.add_argument("path", nargs="+", help="one transect file per reach")
+    parser.add_argument("--column", nargs="+", default=[ELEVATION_COLUMN])
+    parser.add_argument("--cache-path", default=SLOPE_CACHE_PATH)
+    parser.add_argument("--epsilon-min", type=float, default=0)
+    parser.add_argument("--epsilon-max", type=float, default=1)
+    parser.add_argument("--epsilon-step", type=float, default=0.01)
+    parser.add_argument("--half-window", type=int, default=HALF_WINDOW)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+
+    nb_epsilon = round((args.epsilon_max - args.epsilon_min) / args.epsilon_step) + 1
+    epsilon_array = numpy.round(
+        args.epsilon_min + args.epsilon_step * numpy.arange(nb_epsilon), 10
+    )
+    entry_path_list = build_slope_cache(
+        args.path,
+        args.column,
+        args.cache_path,
+        epsilon_array,
+        args.half_window,
+        args.n_jobs,
+        args.force,
+    )
+    for (path, column), entry_path in zip(
+        [(path, column) for path in args.path for column in args.column],
+        entry_path_list,
+    ):
+        print(f"{path} {column}: {entry_path}")
+
+
+if __name__ == "__main__":
+    main()
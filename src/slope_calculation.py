@@ -1,20 +1,74 @@
 import numpy
-from scipy.stats import linregress
+from numpy.lib.stride_tricks import sliding_window_view
 from rdp import rdp
 
 
-def baseline_slope_calculation(pk_array, elevation_array):
-    slope_list = []
-    slope_buffer = [numpy.nan] * 3
-    slope_list.extend(numpy.array([pk_array[:3], slope_buffer]).T)
-    for i in range(3, len(elevation_array) - 3):
-        elevation_subset = elevation_array[i - 3 : i + 3 + 1]
-        pk = pk_array[i]
-        pk_subset = pk_array[i - 3 : i + 3 + 1]
-        reg = linregress(pk_subset, elevation_subset)
-        slope_list.append(numpy.array([pk, reg.slope]))
-    slope_list.extend(numpy.array([pk_array[-3:], slope_buffer]).T)
-    return numpy.array(slope_list)
+def baseline_slope_calculation(pk_array, elevation_array, half_window=3):
+    """
+    Slope of the least-squares line fitted on a centered window of
+    2 * half_window + 1 points, for every point of the profile at once.
+    NaN elevations are left out of their windows and the PK on each edge of
+    the profile (or with less than two valid points) get a NaN slope.
+    """
+    pk_array = numpy.asarray(pk_array, dtype=float)
+    elevation_array = numpy.asarray(elevation_array, dtype=float)
+    slope_array = baseline_slope_matrix_calculation(
+        pk_array, elevation_array[:, None], half_window
+    )[:, 0]
+    return numpy.array([pk_array, slope_array]).T
+
+
+def get_window_slope(pk_window, elevation_window, valid_window):
+    # Least-squares slope of each window, on its valid points only
+    nb_valid = valid_window.sum(axis=1)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        pk_mean = numpy.where(valid_window, pk_window, 0).sum(axis=1) / nb_valid
+        elevation_mean = (
+            numpy.where(valid_window, elevation_window, 0).sum(axis=1) / nb_valid
+        )
+        pk_centered = numpy.where(valid_window, pk_window - pk_mean[:, None], 0)
+        elevation_centered = numpy.where(
+            valid_window, elevation_window - elevation_mean[:, None], 0
+        )
+        ssxm = (pk_centered**2).sum(axis=1)
+        ssxym = (pk_centered * elevation_centered).sum(axis=1)
+        return numpy.where((nb_valid >= 2) & (ssxm > 0), ssxym / ssxm, numpy.nan)
+
+
+def baseline_slope_matrix_calculation(
+    pk_array, elevation_matrix, half_window=3, segment_array=None
+):
+    """
+    baseline_slope_calculation for the n_col columns of elevation_matrix
+    (n, n_col), returned as a (n, n_col) matrix of slopes. With
+    segment_array, the profile is made of several segments (e.g. reaches)
+    stored one after the other and a window can not span two of them.
+    """
+    pk_array = numpy.asarray(pk_array, dtype=float)
+    elevation_matrix = numpy.asarray(elevation_matrix, dtype=float)
+    window_size = 2 * half_window + 1
+    slope_matrix = numpy.full(elevation_matrix.shape, numpy.nan)
+    if len(pk_array) < window_size:
+        return slope_matrix
+    pk_window = sliding_window_view(pk_array, window_size)
+    is_same_segment = None
+    if segment_array is not None:
+        segment_array = numpy.asarray(segment_array)
+        is_same_segment = (
+            segment_array[: 1 - window_size] == segment_array[window_size - 1 :]
+        )[:, None]
+    # Colonne par colonne, les tableaux temporaires restent petits
+    for i in range(elevation_matrix.shape[1]):
+        elevation_window = sliding_window_view(
+            numpy.ascontiguousarray(elevation_matrix[:, i]), window_size
+        )
+        valid_window = ~numpy.isnan(elevation_window)
+        if is_same_segment is not None:
+            valid_window &= is_same_segment
+        slope_matrix[half_window : len(pk_array) - half_window, i] = get_window_slope(
+            pk_window, elevation_window, valid_window
+        )
+    return slope_matrix
 
 
 def get_rdp_points(pk_array, elevation_array, epsilon):
@@ -24,24 +78,45 @@ def get_rdp_points(pk_array, elevation_array, epsilon):
 
 
 def get_rdp_slope(rdp_points_kept):
-    rdp_slope_list = []
-    for i in range(1, len(rdp_points_kept)):
-        pk_tuple = (rdp_points_kept[i - 1][0], rdp_points_kept[i][0])
-        elevation_tuple = (rdp_points_kept[i - 1][1], rdp_points_kept[i][1])
-        slope = (elevation_tuple[1] - elevation_tuple[0]) / (pk_tuple[1] - pk_tuple[0])
-        list_elem = list(pk_tuple) + [slope]
-        rdp_slope_list.append(list_elem)
-    rdp_slope_list = numpy.array(rdp_slope_list)
+    rdp_points_kept = numpy.asarray(rdp_points_kept, dtype=float)
+    pk_difference = numpy.diff(rdp_points_kept[:, 0])
+    elevation_difference = numpy.diff(rdp_points_kept[:, 1])
+    rdp_slope_list = numpy.array(
+        [
+            rdp_points_kept[:-1, 0],
+            rdp_points_kept[1:, 0],
+            elevation_difference / pk_difference,
+        ]
+    ).T
     return rdp_slope_list
 
 
+def get_rdp_segment_index(pk_array, rdp_slope_list):
+    # Segment (start, end] holding each PK, the first PK belongs to the first segment
+    segment_index = numpy.searchsorted(rdp_slope_list[:, 1], pk_array, side="left")
+    segment_index[:1] = 0
+    return segment_index
+
+
 def get_interpolated_rdp_slope(pk_array, rdp_points_kept):
     rdp_slope_list = get_rdp_slope(rdp_points_kept)
-    rpd_slope_interpolation = []
-    rpd_slope_interpolation.append([pk_array[0], rdp_slope_list[0, 2]])
-    for transect in pk_array[1:]:
-        mask = (rdp_slope_list[:, 0] < transect) & (rdp_slope_list[:, 1] >= transect)
-        slope = rdp_slope_list[mask, 2][0]
-        rpd_slope_interpolation.append([transect, slope])
-    rpd_slope_interpolation = numpy.array(rpd_slope_interpolation)
+    segment_index = get_rdp_segment_index(pk_array, rdp_slope_list)
+    rpd_slope_interpolation = numpy.array(
+        [pk_array, rdp_slope_list[segment_index, 2]], dtype=float
+    ).T
     return rpd_slope_interpolation
+
+
+def get_interpolated_rdp_slope_matrix(pk_array, rdp_points_kept_list):
+    """
+    Interpolated rdp slope for many simplifications of the same profile,
+    e.g. one per epsilon. Row i of the returned matrix holds the slope of every
+    PK of pk_array for rdp_points_kept_list[i].
+    """
+    pk_array = numpy.asarray(pk_array, dtype=float)
+    rpd_slope_matrix = numpy.empty((len(rdp_points_kept_list), len(pk_array)))
+    for i, rdp_points_kept in enumerate(rdp_points_kept_list):
+        rdp_slope_list = get_rdp_slope(rdp_points_kept)
+        segment_index = get_rdp_segment_index(pk_array, rdp_slope_list)
+        rpd_slope_matrix[i] = rdp_slope_list[segment_index, 2]
+    return rpd_slope_matrix
@@ -0,0 +1,198 @@
+import functools
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy
+
+from src.rdp_significance import get_rdp_points_from_significance, get_rdp_significance
+from src.slope_calculation import get_interpolated_rdp_slope
+
+EPSILON_LRU_SIZE = 64
+
+
+class SlopeStore:
+    """
+    Read-only access to the precomputed slope arrays saved by save_slope_store.
+    Every array is a .npy file opened lazily with mmap_mode="r", so only the
+    pages of the selected epsilon are read from disk and the same store can be
+    shared by every session of the process. An epsilon that was not
+    precomputed is computed from the rdp significance and the last
+    EPSILON_LRU_SIZE of them are kept in memory.
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = Path(folder_path)
+        self._array_dict = {}
+        self._lock = threading.Lock()
+        self._compute_epsilon_data = functools.lru_cache(maxsize=EPSILON_LRU_SIZE)(
+            self._compute_epsilon_data
+        )
+
+    def _load_array(self, name):
+        if name not in self._array_dict:
+            with self._lock:
+                if name not in self._array_dict:
+                    self._array_dict[name] = numpy.load(
+                        Path(self.folder_path, f"{name}.npy"), mmap_mode="r"
+                    )
+        return self._array_dict[name]
+
+    @property
+    def pk_array(self):
+        return self._load_array("pk_array")
+
+    @property
+    def elevation_array(self):
+        return self._load_array("elevation_array")
+
+    @property
+    def baseline_slope(self):
+        return self._load_array("baseline_slope")
+
+    @property
+    def epsilon_array(self):
+        return self._load_array("epsilon_array")
+
+    @property
+    def rdp_significance(self):
+        if "rdp_significance" not in self._array_dict:
+            with self._lock:
+                if "rdp_significance" not in self._array_dict:
+                    path = Path(self.folder_path, "rdp_significance.npy")
+                    if path.exists():
+                        significance_array = numpy.load(path, mmap_mode="r")
+                    else:
+                        # Store written without the significance
+                        significance_array = get_rdp_significance(
+                            self.pk_array, self.elevation_array
+                        )
+                    self._array_dict["rdp_significance"] = significance_array
+        return self._array_dict["rdp_significance"]
+
+    def validate(self):
+        """
+        Check that every array of the store is there with consistent shapes.
+        Only the .npy headers are read. Raise ValueError otherwise.
+        """
+        try:
+            nb_points = len(self.pk_array)
+            nb_epsilon = len(self.epsilon_array)
+            rdp_points_kept_offset = self._load_array("rdp_points_kept_offset")
+            shape_dict = {
+                "elevation_array": (self.elevation_array.shape, (nb_points,)),
+                "baseline_slope": (self.baseline_slope.shape, (nb_points, 2)),
+                "rdp_points_kept_offset": (
+                    rdp_points_kept_offset.shape,
+                    (nb_epsilon + 1,),
+                ),
+                "rdp_points_kept_array": (
+                    self._load_array("rdp_points_kept_array").shape,
+                    (int(rdp_points_kept_offset[-1]), 2),
+                ),
+                "rdp_slope_matrix": (
+                    self._load_array("rdp_slope_matrix").shape,
+                    (nb_epsilon, nb_points),
+                ),
+            }
+        except (OSError, ValueError) as error:
+            raise ValueError(f"Invalid slope store {self.folder_path}: {error}")
+        for name, (shape, expected_shape) in shape_dict.items():
+            if shape != expected_shape:
+                raise ValueError(
+                    f"Invalid slope store {self.folder_path}: {name} has shape "
+                    f"{shape} instead of {expected_shape}"
+                )
+
+    def get_epsilon_index(self, epsilon):
+        index = numpy.flatnonzero(
+            numpy.isclose(self.epsilon_array, epsilon, rtol=0, atol=1e-9)
+        )
+        if len(index) == 0:
+            raise KeyError(epsilon)
+        return index[0]
+
+    def get_epsilon_data(self, epsilon):
+        try:
+            index = self.get_epsilon_index(epsilon)
+        except KeyError:
+            return self._compute_epsilon_data(float(epsilon))
+        rdp_points_kept_offset = self._load_array("rdp_points_kept_offset")
+        rdp_points_kept_array = self._load_array("rdp_points_kept_array")[
+            rdp_points_kept_offset[index] : rdp_points_kept_offset[index + 1]
+        ]
+        rdp_slope_array = self._load_array("rdp_slope_matrix")[index]
+        rpd_slope_interpolation = numpy.array([self.pk_array, rdp_slope_array]).T
+        return {
+            "rdp_points_kept_array": numpy.array(rdp_points_kept_array),
+            "rpd_slope_interpolation": rpd_slope_interpolation,
+        }
+
+    def _compute_epsilon_data(self, epsilon):
+        pk_array = numpy.array(self.pk_array)
+        rdp_points_kept_array = get_rdp_points_from_significance(
+            pk_array, numpy.array(self.elevation_array), self.rdp_significance, epsilon
+        )
+        return {
+            "rdp_points_kept_array": rdp_points_kept_array,
+            "rpd_slope_interpolation": get_interpolated_rdp_slope(
+                pk_array, rdp_points_kept_array
+            ),
+        }
+
+
+def save_slope_store(data_dict, folder_path, metadata=None):
+    """
+    Write a data_dict (as built by create_slope_data_dict) as a folder of
+    .npy files readable by SlopeStore, with metadata in metadata.json if
+    given. The folder is written in its own temporary folder next to its
+    final location and renamed at the end so readers never see a partial
+    store.
+    """
+    folder_path = Path(folder_path)
+    folder_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_folder_path = Path(
+        tempfile.mkdtemp(prefix=f"{folder_path.name}.tmp", dir=folder_path.parent)
+    )
+
+    epsilon_list = sorted(data_dict["rdp_epsilon"])
+    rdp_points_kept_list = [
+        data_dict["rdp_epsilon"][epsilon]["rdp_points_kept_array"]
+        for epsilon in epsilon_list
+    ]
+    rdp_slope_matrix = numpy.array(
+        [
+            data_dict["rdp_epsilon"][epsilon]["rpd_slope_interpolation"][:, 1]
+            for epsilon in epsilon_list
+        ]
+    ).reshape(len(epsilon_list), len(data_dict["pk_array"]))
+    rdp_points_kept_offset = numpy.concatenate(
+        [[0], numpy.cumsum([len(points) for points in rdp_points_kept_list])]
+    )
+    array_dict = {
+        "pk_array": data_dict["pk_array"],
+        "elevation_array": data_dict["elevation_array"],
+        "baseline_slope": data_dict["baseline_slope"],
+        "epsilon_array": numpy.array(epsilon_list, dtype=float),
+        "rdp_points_kept_offset": rdp_points_kept_offset,
+        "rdp_points_kept_array": numpy.concatenate(rdp_points_kept_list).reshape(-1, 2),
+        "rdp_slope_matrix": rdp_slope_matrix,
+    }
+    if "rdp_significance" in data_dict:
+        array_dict["rdp_significance"] = data_dict["rdp_significance"]
+    for name, array in array_dict.items():
+        numpy.save(Path(temporary_folder_path, f"{name}.npy"), numpy.asarray(array))
+    if metadata is not None:
+        with open(Path(temporary_folder_path, "metadata.json"), "w") as f:
+            json.dump(metadata, f, indent=2)
+
+    try:
+        os.replace(temporary_folder_path, folder_path)
+    except OSError:
+        # Another process already wrote the store
+        shutil.rmtree(temporary_folder_path, ignore_errors=True)
+        if not folder_path.exists():
+            raise
@@ -0,0 +1,150 @@
+import numpy
+import pandas
+
+from src.rdp_significance import get_rdp_mask, get_rdp_significance
+from src.slope_calculation import (
+    baseline_slope_matrix_calculation,
+    get_interpolated_rdp_slope_matrix,
+)
+from src.transect_loader import iter_transect_reaches, read_transects
+
+SLOPE_TABLE_COLUMN_LIST = [
+    "column",
+    "epsilon",
+    "PK",
+    "elevation",
+    "is_rdp_point",
+    "baseline_slope",
+    "rdp_slope",
+]
+
+
+def get_sorted_reach_and_pk(df, reach_column=None):
+    """
+    Reach code (position in the sorted reach labels), reach labels and order
+    of the rows of df sorted by reach then PK, without the duplicated PK of a
+    reach (the last one is kept like load_data_and_drop_duplicated). The rows
+    without a reach form their own reach, labelled NaN, after the others.
+    """
+    if reach_column is None:
+        reach_code_array = numpy.zeros(len(df), dtype=int)
+        reach_label_array = numpy.array([None])
+    else:
+        reach_code_array, reach_label_array = pandas.factorize(
+            df[reach_column], sort=True, use_na_sentinel=False
+        )
+    pk_array = df["PK"].to_numpy(dtype=float)
+    order_array = numpy.lexsort((pk_array, reach_code_array))
+    reach_code_array = reach_code_array[order_array]
+    pk_array = pk_array[order_array]
+    is_last_array = numpy.ones(len(pk_array), dtype=bool)
+    is_last_array[:-1] = (pk_array[1:] != pk_array[:-1]) | (
+        reach_code_array[1:] != reach_code_array[:-1]
+    )
+    return (
+        reach_code_array[is_last_array],
+        numpy.asarray(reach_label_array),
+        order_array[is_last_array],
+    )
+
+
+def compute_slope_table(
+    df, column_list, epsilon_list, reach_column=None, half_window=3
+):
+    """
+    Baseline and rdp slopes of every elevation column of column_list, for
+    every reach of df (the values of reach_column, or the whole table if
+    None) and every epsilon of epsilon_list.
+    The baseline slope of all the reaches and columns is computed in one
+    pass and the rdp recursion runs once per reach and column, whatever the
+    number of epsilons. Return a tidy DataFrame with one row per reach,
+    column, epsilon and PK.
+    """
+    epsilon_array = numpy.atleast_1d(numpy.asarray(epsilon_list, dtype=float))
+    reach_code_array, reach_label_array, order_array = get_sorted_reach_and_pk(
+        df, reach_column
+    )
+    pk_array = df["PK"].to_numpy(dtype=float)[order_array]
+    elevation_matrix = df[column_list].to_numpy(dtype=float)[order_array]
+    baseline_slope_matrix = baseline_slope_matrix_calculation(
+        pk_array, elevation_matrix, half_window, reach_code_array
+    )
+
+    nb_points = len(pk_array)
+    shape = (len(column_list), len(epsilon_array), nb_points)
+    is_rdp_point_array = numpy.zeros(shape, dtype=bool)
+    rdp_slope_array = numpy.full(shape, numpy.nan)
+    reach_bound_array = numpy.concatenate(
+        [[0], numpy.flatnonzero(numpy.diff(reach_code_array)) + 1, [nb_points]]
+    )
+    for start, end in zip(reach_bound_array[:-1], reach_bound_array[1:]):
+        if end - start < 2:
+            continue
+        reach_pk_array = pk_array[start:end]
+        for i in range(len(column_list)):
+            reach_elevation_array = elevation_matrix[start:end, i]
+            significance_array = get_rdp_significance(
+                reach_pk_array, reach_elevation_array
+            )
+            rdp_points_kept_list = []
+            for j, epsilon in enumerate(epsilon_array):
+                mask = get_rdp_mask(significance_array, epsilon)
+                is_rdp_point_array[i, j, start:end] = mask
+                rdp_points_kept_list.append(
+                    numpy.array([reach_pk_array[mask], reach_elevation_array[mask]]).T
+                )
+            rdp_slope_array[i, :, start:end] = get_interpolated_rdp_slope_matrix(
+                reach_pk_array, rdp_points_kept_list
+            )
+
+    slope_table = pandas.DataFrame(
+        {
+            "column": numpy.repeat(column_list, len(epsilon_array) * nb_points),
+            "epsilon": numpy.tile(
+                numpy.repeat(epsilon_array, nb_points), len(column_list)
+            ),
+            "PK": numpy.tile(pk_array, len(column_list) * len(epsilon_array)),
+            "elevation": numpy.repeat(
+                elevation_matrix.T, len(epsilon_array), axis=0
+            ).ravel(),
+            "is_rdp_point": is_rdp_point_array.ravel(),
+            "baseline_slope": numpy.repeat(
+                baseline_slope_matrix.T, len(epsilon_array), axis=0
+            ).ravel(),
+            "rdp_slope": rdp_slope_array.ravel(),
+        },
+        columns=SLOPE_TABLE_COLUMN_LIST,
+    )
+    if reach_column is not None:
+        slope_table.insert(
+            0,
+            reach_column,
+            numpy.tile(
+                reach_label_array[reach_code_array],
+                len(column_list) * len(epsilon_array),
+            ),
+        )
+    return slope_table
+
+
+def compute_slope_table_from_file(
+    path, column_list, epsilon_list, reach_column=None, half_window=3
+):
+    """
+    compute_slope_table on the transects of the file at path, read one reach
+    at a time with only the PK, reach and elevation columns.
+    """
+    if reach_column is None:
+        df = read_transects(path, ["PK"] + column_list, ignore_geometry=True)
+        return compute_slope_table(df, column_list, epsilon_list, None, half_window)
+    return pandas.concat(
+        [
+            compute_slope_table(
+                reach_df, column_list, epsilon_list, reach_column, half_window
+            )
+            for _, reach_df in iter_transect_reaches(
+                path, reach_column, ["PK"] + column_list, ignore_geometry=True
+            )
+        ],
+        ignore_index=True,
+    )
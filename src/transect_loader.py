@@ -0,0 +1,125 @@
+import re
+
+import numpy
+import pandas
+
+READ_CHUNK_SIZE = 20000
+
+
+def get_pk_where(pk_range):
+    # Filtre OGR SQL sur [pk_min, pk_max)
+    pk_min, pk_max = pk_range
+    return f"PK >= {float(pk_min)!r} AND PK < {float(pk_max)!r}"
+
+
+def get_equal_where(column, value):
+    if pandas.isna(value):
+        return f'"{column}" IS NULL'
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, str):
+        value = "'" + value.replace("'", "''") + "'"
+    return f'"{column}" = {value}'
+
+
+def get_where_column_list(path, where):
+    # Champs de la couche cités dans le filtre OGR SQL
+    import fiona
+
+    with fiona.open(path) as collection:
+        field_list = list(collection.schema["properties"])
+    word_set = set(re.findall(r"\w+", where))
+    return [field for field in field_list if field in word_set]
+
+
+def read_transects(
+    path,
+    column_list=None,
+    bbox=None,
+    pk_range=None,
+    rows=None,
+    where=None,
+    ignore_geometry=False,
+):
+    """
+    Read only part of a transect file: the columns of column_list (all if
+    None), the transects intersecting bbox (minx, miny, maxx, maxy), with a
+    PK in pk_range [pk_min, pk_max), matching the OGR SQL where and among the
+    rows of the slice rows. The filters are applied by the driver, the rest
+    of the file is never loaded in memory. The columns used by the filters
+    are read even if they are not in column_list, and dropped afterwards.
+    """
+    # geopandas est lent à importer, il n'est chargé que pour lire les données
+    import geopandas
+
+    kwargs = {}
+    if isinstance(bbox, (list, numpy.ndarray)):
+        bbox = tuple(bbox)
+    where_list = [where] if where is not None else []
+    if pk_range is not None:
+        where_list.append(get_pk_where(pk_range))
+    if where_list:
+        kwargs["where"] = " AND ".join(f"({where})" for where in where_list)
+    filter_column_list = []
+    if column_list is not None:
+        # Un champ absent de include_fields ne peut pas être filtré
+        if where is not None:
+            filter_column_list.extend(get_where_column_list(path, where))
+        if pk_range is not None:
+            filter_column_list.append("PK")
+        filter_column_list = [
+            column
+            for column in dict.fromkeys(filter_column_list)
+            if column not in column_list
+        ]
+        kwargs["include_fields"] = list(column_list) + filter_column_list
+    df = geopandas.read_file(
+        path, bbox=bbox, rows=rows, ignore_geometry=ignore_geometry, **kwargs
+    )
+    return df.drop(columns=filter_column_list)
+
+
+def get_pk_chunk_list(pk_array, chunk_size=READ_CHUNK_SIZE, pk_margin=0):
+    """
+    Split the distinct PK of pk_array in consecutive ranges of chunk_size
+    PK. Return a (pk_range, read_pk_range) pair per range, both [pk_min,
+    pk_max): read_pk_range also holds the PK just before and after
+    pk_range and those within pk_margin of it.
+    """
+    pk_array = numpy.unique(numpy.asarray(pk_array, dtype=float))
+    if len(pk_array) == 0:
+        return []
+    # Borne exclusive juste au-dessus du dernier PK
+    pk_bound_array = numpy.append(pk_array, numpy.nextafter(pk_array[-1], numpy.inf))
+    pk_chunk_list = []
+    for start in range(0, len(pk_array), chunk_size):
+        end = min(start + chunk_size, len(pk_array))
+        read_pk_min = min(pk_array[max(start - 1, 0)], pk_array[start] - pk_margin)
+        read_pk_max = max(
+            pk_bound_array[min(end + 1, len(pk_array))],
+            numpy.nextafter(pk_array[end - 1] + pk_margin, numpy.inf),
+        )
+        pk_chunk_list.append(
+            (
+                (float(pk_array[start]), float(pk_bound_array[end])),
+                (float(read_pk_min), float(read_pk_max)),
+            )
+        )
+    return pk_chunk_list
+
+
+def iter_transect_reaches(path, reach_column, column_list=None, **read_kwargs):
+    """
+    Yield (reach, transects of the reach) for each value of reach_column,
+    reading one reach at a time.
+    """
+    reach_array = read_transects(path, [reach_column], ignore_geometry=True)[
+        reach_column
+    ].unique()
+    if column_list is not None and reach_column not in column_list:
+        column_list = [reach_column] + column_list
+    for reach in reach_array:
+        reach_df = read_transects(
+            path, column_list, where=get_equal_where(reach_column, reach), **read_kwargs
+        )
+        yield reach, reach_df
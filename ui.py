@@ -1,6 +1,17 @@
 from shiny import ui
 from shinywidgets import output_widget
 
+from src.epsilon_selection import SELECTION_CRITERION_LIST
+from src.export_job import EXPORT_FORMAT_LIST
+
+RDP_EPSILON_DEFAULT = 0.1
+EPSILON_TARGET_DEFAULT = 0.05
+SELECTION_CRITERION_LABEL_DICT = dict(
+    zip(
+        SELECTION_CRITERION_LIST,
+        ["RMSE de l'élévation (m) max", "RMSE de la pente max", "Compression min"],
+    )
+)
 
 ui_main = ui.page_fluid(
     ui.h1("Exploration de l'algorithme de Ramer-Douglas-Peucker"),
@@ -12,9 +23,20 @@ ui_main = ui.page_fluid(
                 min=0,
                 max=1,
                 step=0.01,
-                value=0.1,
+                value=RDP_EPSILON_DEFAULT,
+            ),
+            ui.input_select(
+                "epsilon_criterion",
+                "Critère du choix d'epsilon",
+                SELECTION_CRITERION_LABEL_DICT,
+            ),
+            ui.input_numeric(
+                "epsilon_target", "Cible", min=0, value=EPSILON_TARGET_DEFAULT
             ),
-            ui.download_button("download_csv_file", "Download csv file"),
+            ui.input_action_button("select_epsilon", "Choisir epsilon"),
+            ui.input_select("export_format", "Format de l'export", EXPORT_FORMAT_LIST),
+            ui.download_button("download_csv_file", "Download file"),
+            ui.input_action_button("cancel_export", "Annuler l'export"),
             width=350,
         ),
         output_widget(
@@ -27,5 +49,6 @@ ui_main = ui.page_fluid(
             # width="900px",
             # height="900px",
         ),
+        output_widget("generate_epsilon_metric_plot"),
     ),
 )